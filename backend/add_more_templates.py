@@ -784,6 +784,9 @@ for template in new_templates:
     else:
         print(f"- Already exists: {template['name']}")
 
+# Let running API servers know the template catalog changed
+db.collection_versions.update_one({"_id": "templates"}, {"$inc": {"version": 1}}, upsert=True)
+
 print("=" * 60)
 print(f"\n✅ Added {templates_added} new templates")
 print(f"📊 Total templates in database: {db.templates.count_documents({})}")
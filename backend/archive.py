@@ -0,0 +1,353 @@
+"""Archive cold analytics events to partitioned Parquet files.
+
+Raw events older than ANALYTICS_ARCHIVE_AFTER_DAYS are moved out of the
+analytics collection into zstd-compressed Parquet files under ARCHIVE_DIR:
+
+    funnel_id={funnel_id}/month={YYYY-MM}/part-{cutoff}.parquet
+
+Each run archives the events in (previous cutoff, cutoff] and then records
+the cutoff as the funnel's watermark in the analytics_archive collection.
+Readers take events at or before the watermark from the files and newer ones
+from MongoDB, so nothing is counted twice even if a run stops half-way; part
+files newer than the watermark are leftovers of such a run and are removed on
+the next one.
+
+Next to each part a sessions-{cutoff}.parquet file holds the same events'
+(session, timestamp, page_id) sorted by session and time, so drop-off
+analysis can merge the archive with the live stream in bounded memory. The
+archive job writes it: each batch of events is sorted into a temporary run
+file, and the runs are merged when the month's part is closed.
+
+Run `python archive.py [--older-than-days N] [--funnel-id ID]`, e.g. daily.
+"""
+import argparse
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta
+import heapq
+import itertools
+import json
+import os
+import re
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from files import in_thread, valid_funnel_id
+import repository as repo
+
+ARCHIVE_DIR = os.path.abspath(os.getenv("ARCHIVE_DIR", "archive"))
+ANALYTICS_ARCHIVE_AFTER_DAYS = int(os.getenv("ANALYTICS_ARCHIVE_AFTER_DAYS", 90))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 50000))
+SESSION_BATCH_SIZE = int(os.getenv("SESSION_BATCH_SIZE", 5000))
+
+SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("funnel_id", pa.string()),
+    ("page_id", pa.string()),
+    ("event_type", pa.string()),
+    ("timestamp", pa.timestamp("ms")),
+    ("metadata", pa.string()),
+])
+
+# Session files: events of a part sorted by session_key, then timestamp
+SESSION_SCHEMA = pa.schema([
+    ("session_rank", pa.int8()),
+    ("session_number", pa.float64()),
+    ("session_text", pa.string()),
+    ("timestamp", pa.timestamp("ms")),
+    ("page_id", pa.string()),
+])
+SESSION_SORT = [(name, "ascending") for name in ("session_rank", "session_number", "session_text", "timestamp")]
+# Rows read at a time from each sorted run while merging them
+SESSION_RUN_BATCH_SIZE = 1024
+
+TOKEN_FORMAT = "%Y%m%dT%H%M%S%f"
+PART_NAME = re.compile(r"^part-(\d{8}T\d{12})\.parquet$")
+SESSIONS_NAME = re.compile(r"^sessions-(\d{8}T\d{12})\.parquet$")
+
+def session_key(value) -> tuple:
+    """Sort key of a session id, following MongoDB's order for the types JSON can carry.
+
+    Numbers sort before strings, then objects and arrays (approximately), then
+    booleans, so the archive merges with live events sorted by MongoDB.
+    """
+    if isinstance(value, bool):
+        return (8, float(value), "")
+    if isinstance(value, (int, float)):
+        return (1, float(value), "")
+    if isinstance(value, str):
+        return (2, 0.0, value)
+    return (3 if isinstance(value, dict) else 4, 0.0, json.dumps(value, sort_keys=True, default=str))
+
+# Files
+
+def _funnel_dir(funnel_id: str) -> str:
+    if not valid_funnel_id(funnel_id):
+        raise ValueError(f"Invalid funnel id: {funnel_id!r}")
+    return os.path.join(ARCHIVE_DIR, f"funnel_id={funnel_id}")
+
+def _month(timestamp: datetime) -> str:
+    return f"{timestamp:%Y-%m}"
+
+def _parts(funnel_id: str, start=None, end=None, watermark=None) -> list:
+    """Part files of a funnel in time order, limited to months overlapping [start, end]"""
+    funnel_dir = _funnel_dir(funnel_id)
+    if not os.path.isdir(funnel_dir):
+        return []
+    limit = watermark.strftime(TOKEN_FORMAT) if watermark else None
+    parts = []
+    for month_dir in sorted(os.listdir(funnel_dir)):
+        month = month_dir[len("month="):]
+        if (start and month < _month(start)) or (end and month > _month(end)):
+            continue
+        for name in os.listdir(os.path.join(funnel_dir, month_dir)):
+            match = PART_NAME.match(name)
+            if match and (limit is None or match.group(1) <= limit):
+                parts.append((month, match.group(1), os.path.join(funnel_dir, month_dir, name)))
+    return [path for _, _, path in sorted(parts)]
+
+def _remove_orphans(funnel_id: str, watermark):
+    """Delete part files written after the watermark by an interrupted run"""
+    funnel_dir = _funnel_dir(funnel_id)
+    if not os.path.isdir(funnel_dir):
+        return
+    limit = watermark.strftime(TOKEN_FORMAT) if watermark else ""
+    for month_dir in os.listdir(funnel_dir):
+        for name in os.listdir(os.path.join(funnel_dir, month_dir)):
+            match = PART_NAME.match(name) or SESSIONS_NAME.match(name)
+            if name.endswith(".tmp") or (match and match.group(1) > limit):
+                os.remove(os.path.join(funnel_dir, month_dir, name))
+
+def _row(event: dict) -> dict:
+    metadata = event.get("metadata")
+    return {
+        "id": event.get("id"),
+        "funnel_id": event.get("funnel_id"),
+        "page_id": event.get("page_id"),
+        "event_type": event.get("event_type"),
+        "timestamp": event.get("timestamp"),
+        "metadata": json.dumps(metadata, default=str) if metadata is not None else None,
+    }
+
+def _session_row(event: dict):
+    metadata = event.get("metadata")
+    session = metadata.get("session_id") if isinstance(metadata, dict) else None
+    if session is None:
+        return None
+    rank, number, text = session_key(session)
+    return {"session_rank": rank, "session_number": number, "session_text": text,
+            "timestamp": event.get("timestamp"), "page_id": event.get("page_id")}
+
+def _session_tuples(path: str, batch_size: int, start=None, end=None):
+    """(session_rank, session_number, session_text, timestamp, page_id) rows of a session file, read in batches"""
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+        table = _filter(pa.Table.from_batches([batch]), start, end)
+        yield from zip(*(table[name].to_pylist() for name in SESSION_SCHEMA.names))
+
+def _merge_runs(runs: list, path: str):
+    """Merge sorted session runs into one sorted session file and delete the runs"""
+    writer = pq.ParquetWriter(f"{path}.tmp", SESSION_SCHEMA, compression="zstd")
+    rows = heapq.merge(*(_session_tuples(run, SESSION_RUN_BATCH_SIZE) for run in runs), key=lambda row: row[:4])
+    while True:
+        chunk = list(itertools.islice(rows, SESSION_BATCH_SIZE))
+        if not chunk:
+            break
+        columns = [list(column) for column in zip(*chunk)]
+        writer.write_table(pa.Table.from_arrays(columns, schema=SESSION_SCHEMA))
+    writer.close()
+    os.replace(f"{path}.tmp", path)
+    for run in runs:
+        os.remove(run)
+
+def _sessions_path(part_path: str) -> str:
+    directory, name = os.path.split(part_path)
+    return os.path.join(directory, "sessions-" + name[len("part-"):])
+
+class _PartWriter:
+    """Writes time-ordered events into one part file per month, one month at a time.
+
+    Each written batch's sessions are sorted into a run file; closing a month
+    merges its runs into the month's session file.
+    """
+    def __init__(self, funnel_id: str, token: str):
+        self.funnel_dir = _funnel_dir(funnel_id)
+        self.token = token
+        self.month = None
+        self.writer = None
+        self.path = None
+        self.runs = []
+        self.written = 0
+
+    def write(self, events: list):
+        rows, sessions = [], []
+        for event in events:
+            month = _month(event["timestamp"])
+            if month != self.month:
+                self._write_rows(rows, sessions)
+                rows, sessions = [], []
+                self._open(month)
+            rows.append(_row(event))
+            session = _session_row(event)
+            if session is not None:
+                sessions.append(session)
+        self._write_rows(rows, sessions)
+
+    def _open(self, month: str):
+        self.close()
+        month_dir = os.path.join(self.funnel_dir, f"month={month}")
+        os.makedirs(month_dir, exist_ok=True)
+        self.month = month
+        self.path = os.path.join(month_dir, f"part-{self.token}.parquet")
+        self.writer = pq.ParquetWriter(f"{self.path}.tmp", SCHEMA, compression="zstd")
+
+    def _write_rows(self, rows: list, sessions: list):
+        if rows:
+            self.writer.write_table(pa.Table.from_pylist(rows, schema=SCHEMA))
+            self.written += len(rows)
+        if sessions:
+            run = f"{_sessions_path(self.path)}.{len(self.runs)}.tmp"
+            table = pa.Table.from_pylist(sessions, schema=SESSION_SCHEMA).sort_by(SESSION_SORT)
+            pq.write_table(table, run, row_group_size=SESSION_RUN_BATCH_SIZE)
+            self.runs.append(run)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            _merge_runs(self.runs, _sessions_path(self.path))
+            os.replace(f"{self.path}.tmp", self.path)
+            self.runs = []
+            self.writer = None
+
+# Archiving
+
+async def archive_funnel(funnel_id: str, cutoff: datetime) -> int:
+    """Move a funnel's events at or before cutoff into Parquet; returns the number archived"""
+    watermark = await repo.get_archive_watermark(funnel_id)
+    if watermark and watermark >= cutoff:
+        return 0
+    await in_thread(_remove_orphans, funnel_id, watermark)
+    if watermark:
+        # Finish the delete of a run that stopped after recording its watermark
+        await repo.delete_events(funnel_id, watermark)
+
+    writer = _PartWriter(funnel_id, cutoff.strftime(TOKEN_FORMAT))
+    batch = []
+    try:
+        async for event in repo.stream_events(funnel_id, end=cutoff, after=watermark, batch_size=ARCHIVE_BATCH_SIZE):
+            batch.append(event)
+            if len(batch) >= ARCHIVE_BATCH_SIZE:
+                await in_thread(writer.write, batch)
+                batch = []
+        await in_thread(writer.write, batch)
+    finally:
+        await in_thread(writer.close)
+
+    await repo.set_archive_watermark(funnel_id, cutoff)
+    await repo.delete_events(funnel_id, cutoff)
+    return writer.written
+
+async def archive_events(older_than_days: int = ANALYTICS_ARCHIVE_AFTER_DAYS, funnel_id: str = None) -> dict:
+    """Archive events older than the given age for one funnel, or for all funnels"""
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    # Millisecond precision, matching how MongoDB stores timestamps
+    cutoff = cutoff.replace(microsecond=cutoff.microsecond // 1000 * 1000)
+    funnel_ids = [funnel_id] if funnel_id else await repo.list_event_funnel_ids(cutoff)
+    archived = {}
+    for funnel in funnel_ids:
+        try:
+            archived[funnel] = await archive_funnel(funnel, cutoff)
+        except ValueError as exc:
+            # Funnel ids come from the public tracking endpoint; one bad id must not stop the run
+            print(f"✗ Skipped funnel {funnel!r}: {exc}")
+    return archived
+
+# Reading
+
+def _filter(table, start=None, end=None):
+    if start:
+        table = table.filter(pc.greater_equal(table["timestamp"], pa.scalar(start, pa.timestamp("ms"))))
+    if end:
+        table = table.filter(pc.less_equal(table["timestamp"], pa.scalar(end, pa.timestamp("ms"))))
+    return table
+
+def _event(row: dict) -> dict:
+    if row.get("metadata") is not None:
+        row["metadata"] = json.loads(row["metadata"])
+    return row
+
+async def iter_events(funnel_id: str, start=None, end=None, watermark=None, batch_size: int = 5000):
+    """Archived events of a funnel in time order, yielded in lists of up to batch_size"""
+    if watermark is None:
+        return
+    end = min(end, watermark) if end else watermark
+    for path in await in_thread(_parts, funnel_id, start, end, watermark):
+        batches = pq.ParquetFile(path).iter_batches(batch_size=batch_size)
+        while True:
+            batch = await in_thread(next, batches, None)
+            if batch is None:
+                break
+            table = _filter(pa.Table.from_batches([batch]), start, end)
+            if table.num_rows:
+                yield [_event(row) for row in table.to_pylist()]
+
+def _session_rows(path: str, start, end):
+    """(session key, timestamp, page_id) tuples of one session file, read in batches"""
+    for rank, number, text, timestamp, page_id in _session_tuples(path, SESSION_BATCH_SIZE, start, end):
+        yield (rank, number, text), timestamp, page_id
+
+def _merged_sessions(funnel_id: str, start, end, watermark):
+    paths = [_sessions_path(path) for path in _parts(funnel_id, start, end, watermark)]
+    return heapq.merge(*(_session_rows(path, start, end) for path in paths), key=lambda row: row[:2])
+
+async def iter_sessions(funnel_id: str, start=None, end=None, watermark=None):
+    """Archived (session key, timestamp, page_id) tuples sorted by session, then time, in lists.
+
+    Each session file is streamed in batches, so memory grows with the number
+    of part files rather than the number of archived events.
+    """
+    if watermark is None:
+        return
+    end = min(end, watermark) if end else watermark
+    rows = await in_thread(_merged_sessions, funnel_id, start, end, watermark)
+    while True:
+        chunk = await in_thread(lambda: list(itertools.islice(rows, SESSION_BATCH_SIZE)))
+        if not chunk:
+            break
+        yield chunk
+
+def _hourly_counts(funnel_id: str = None, watermarks: dict = None, before=None) -> Counter:
+    counts = Counter()
+    watermarks = watermarks or {}
+    funnel_ids = [funnel_id] if funnel_id else [
+        name[len("funnel_id="):] for name in (os.listdir(ARCHIVE_DIR) if os.path.isdir(ARCHIVE_DIR) else [])
+        if name.startswith("funnel_id=")
+    ]
+    for funnel in funnel_ids:
+        if funnel not in watermarks:
+            continue
+        for path in _parts(funnel, watermark=watermarks[funnel]):
+            table = pq.read_table(path, columns=["page_id", "event_type", "timestamp"])
+            if before is not None:
+                table = table.filter(pc.less(table["timestamp"], pa.scalar(before, pa.timestamp("ms"))))
+            table = table.set_column(2, "hour", pc.floor_temporal(table["timestamp"], unit="hour"))
+            grouped = table.group_by(["page_id", "event_type", "hour"]).aggregate([([], "count_all")])
+            for row in grouped.to_pylist():
+                counts[(funnel, row["page_id"], row["event_type"], row["hour"])] += row["count_all"]
+    return counts
+
+async def hourly_counts(funnel_id: str = None, before=None) -> Counter:
+    """Archived event counts keyed by (funnel_id, page_id, event_type, hour), for events before `before`"""
+    watermarks = await repo.get_archive_watermarks()
+    return await in_thread(_hourly_counts, funnel_id, watermarks, before)
+
+async def main(older_than_days: int, funnel_id: str = None):
+    archived = await archive_events(older_than_days, funnel_id)
+    print(f"✓ Archived {sum(archived.values())} events from {len(archived)} funnels to {ARCHIVE_DIR}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move old analytics events into Parquet archives")
+    parser.add_argument("--older-than-days", type=int, default=ANALYTICS_ARCHIVE_AFTER_DAYS,
+                        help="archive events older than this many days")
+    parser.add_argument("--funnel-id", help="only archive events of this funnel")
+    args = parser.parse_args()
+    asyncio.run(main(args.older_than_days, args.funnel_id))
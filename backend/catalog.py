@@ -0,0 +1,59 @@
+"""Pre-serialized template catalog.
+
+GET /api/templates serves a snapshot of the whole templates collection that
+is serialized once, together with a strong ETag. The snapshot is rebuilt only
+when the templates version marker (bumped by every script or route that
+changes templates) moves. The marker is checked at most once every
+TEMPLATE_CATALOG_CHECK_INTERVAL seconds.
+"""
+import asyncio
+import hashlib
+import os
+import time
+import fastjson
+import repository as repo
+
+TEMPLATE_CATALOG_CHECK_INTERVAL = float(os.getenv("TEMPLATE_CATALOG_CHECK_INTERVAL", 5))
+
+class CatalogSnapshot:
+    def __init__(self, version, templates: list, body: bytes):
+        self.version = version
+        self.templates = {template["id"]: template for template in templates if "id" in template}
+        self.body = body
+        self.etag = '"' + hashlib.sha256(body).hexdigest() + '"'
+
+class TemplateCatalog:
+    def __init__(self, check_interval=TEMPLATE_CATALOG_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.snapshot = None
+        self._checked_at = 0.0
+        self._lock = None
+
+    async def get(self) -> CatalogSnapshot:
+        if self.snapshot is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return self.snapshot
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            # Another request may have refreshed while we waited for the lock
+            if self.snapshot is not None and time.monotonic() - self._checked_at < self.check_interval:
+                return self.snapshot
+            version = await repo.get_collection_version("templates")
+            if self.snapshot is None or self.snapshot.version != version:
+                templates = await repo.list_templates()
+                body = fastjson.dumps(templates)
+                self.snapshot = CatalogSnapshot(version, templates, body)
+            self._checked_at = time.monotonic()
+        return self.snapshot
+
+    async def get_template(self, template_id: str):
+        """Look a template up in the snapshot, falling back to the database"""
+        template = (await self.get()).templates.get(template_id)
+        if template is None:
+            template = await repo.get_template(template_id)
+        return template
+
+    def invalidate(self):
+        self.snapshot = None
+
+template_catalog = TemplateCatalog()
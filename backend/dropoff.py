@@ -0,0 +1,97 @@
+"""Step-by-step funnel drop-off over visitor sessions.
+
+Tracked events carry a visitor session id in `metadata.session_id`. Events
+are streamed from MongoDB sorted by session and time, and each session is
+walked against the funnel's ordered `pages` list: a session reaches step n
+once it has visited pages 1..n in that order (later visits may repeat or
+skip back). Only the current session's progress is held in memory, so the
+walk scales with the number of funnel steps, not the number of events.
+Archived events (see archive.py) are streamed sorted the same way and merged
+in, a batch at a time. Sessions are compared by archive.session_key on both
+sides, which follows MongoDB's sort order.
+"""
+import repository as repo
+
+class SessionWalker:
+    """Track the furthest step of each session; events must arrive sorted by session, then time.
+
+    depths[n] counts the sessions that completed exactly n steps.
+    """
+    def __init__(self, steps: list):
+        self.steps = steps
+        self.step_index = {page_id: index for index, page_id in enumerate(steps)}
+        self.depths = [0] * (len(steps) + 1)
+        self.session_id = None
+        self.depth = 0
+
+    def feed(self, session_id, page_id):
+        if session_id != self.session_id:
+            self.finish()
+            self.session_id = session_id
+        if self.depth < len(self.steps) and self.step_index.get(page_id) == self.depth:
+            self.depth += 1
+
+    def finish(self) -> list:
+        if self.session_id is not None:
+            self.depths[self.depth] += 1
+        self.session_id, self.depth = None, 0
+        return self.depths
+
+def summarize(depths: list, steps: list, names: dict = None) -> dict:
+    """Turn a depth histogram into per-step reach and drop-off"""
+    names = names or {}
+    sessions = sum(depths)
+    reached = []
+    remaining = sessions
+    for depth in range(len(steps)):
+        remaining -= depths[depth]
+        reached.append(remaining)
+
+    report = []
+    previous = sessions
+    for index, page_id in enumerate(steps):
+        count = reached[index]
+        next_count = reached[index + 1] if index + 1 < len(steps) else count
+        report.append({
+            "step": index + 1,
+            "page_id": page_id,
+            "name": names.get(page_id),
+            "reached": count,
+            "dropped_off": count - next_count,
+            "step_conversion": round(count / previous * 100, 2) if previous else 0,
+            "overall_conversion": round(count / sessions * 100, 2) if sessions else 0,
+        })
+        previous = count
+    return {
+        "sessions": sessions,
+        "completed": reached[-1] if steps else 0,
+        "steps": report,
+    }
+
+async def funnel_dropoff(funnel: dict, start=None, end=None) -> dict:
+    import archive
+
+    steps = list(funnel.get("pages") or [])
+    watermark = await repo.get_archive_watermark(funnel["id"])
+    archived = archive.iter_sessions(funnel["id"], start, end, watermark)
+    batch, position = await anext(archived, []), 0
+    walker = SessionWalker(steps)
+    async for event in repo.stream_session_events(funnel["id"], start, end, after=watermark):
+        session = event["metadata"]["session_id"]
+        if session is None:
+            continue
+        key = (archive.session_key(session), event["timestamp"])
+        while batch and batch[position][:2] <= key:
+            walker.feed(batch[position][0], batch[position][2])
+            position += 1
+            if position == len(batch):
+                batch, position = await anext(archived, []), 0
+        walker.feed(key[0], event.get("page_id"))
+    while batch:
+        for session_key, _, page_id in batch[position:]:
+            walker.feed(session_key, page_id)
+        batch, position = await anext(archived, []), 0
+    depths = walker.finish()
+    pages = await repo.list_funnel_page_names(funnel["id"])
+    names = {page["id"]: page.get("name") for page in pages}
+    return {"funnel_id": funnel["id"], **summarize(depths, steps, names)}
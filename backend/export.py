@@ -0,0 +1,118 @@
+"""Streaming export of raw analytics events.
+
+Events are read through a server-side cursor and encoded chunk by chunk as
+NDJSON, CSV or Parquet (one row group per chunk), so an export of any size
+uses memory proportional to EXPORT_CHUNK_SIZE rather than to the result.
+Archived events are read from their Parquet partitions the same way.
+"""
+import csv
+from datetime import datetime
+import io
+import json
+import os
+import repository as repo
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 5000))
+
+COLUMNS = ["id", "funnel_id", "page_id", "event_type", "timestamp", "metadata"]
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+async def _chunks(cursor, size: int):
+    chunk = []
+    async for event in cursor:
+        chunk.append(event)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+async def _ndjson(chunks):
+    async for chunk in chunks:
+        yield "".join(json.dumps(event, default=_json_default) + "\n" for event in chunk).encode()
+
+async def _csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    async for chunk in chunks:
+        for event in chunk:
+            metadata = event.get("metadata")
+            writer.writerow([
+                event.get("id"), event.get("funnel_id"), event.get("page_id"), event.get("event_type"),
+                event["timestamp"].isoformat() if event.get("timestamp") else "",
+                json.dumps(metadata, default=_json_default) if metadata is not None else "",
+            ])
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+class _Sink(io.RawIOBase):
+    """Write-only file that hands back whatever has been written since the last drain"""
+    def __init__(self):
+        self._parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+async def _parquet(chunks):
+    # pyarrow is only loaded when a Parquet export is requested
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import archive
+
+    schema = archive.SCHEMA
+    sink = _Sink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    async for chunk in chunks:
+        writer.write_table(pa.Table.from_pylist([
+            {
+                "id": event.get("id"),
+                "funnel_id": event.get("funnel_id"),
+                "page_id": event.get("page_id"),
+                "event_type": event.get("event_type"),
+                "timestamp": event.get("timestamp"),
+                "metadata": json.dumps(event["metadata"], default=_json_default)
+                            if event.get("metadata") is not None else None,
+            }
+            for event in chunk
+        ], schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+ENCODERS = {"ndjson": _ndjson, "csv": _csv, "parquet": _parquet}
+
+async def _event_chunks(funnel_id: str, start=None, end=None):
+    import archive
+
+    # Archived events come first, then live events newer than the archive watermark
+    watermark = await repo.get_archive_watermark(funnel_id)
+    async for chunk in archive.iter_events(funnel_id, start, end, watermark, EXPORT_CHUNK_SIZE):
+        yield chunk
+    cursor = repo.stream_events(funnel_id, start, end, after=watermark, batch_size=EXPORT_CHUNK_SIZE)
+    async for chunk in _chunks(cursor, EXPORT_CHUNK_SIZE):
+        yield chunk
+
+def export_events(funnel_id: str, fmt: str, start=None, end=None):
+    """Async iterator of encoded export bytes for a funnel's events in [start, end]"""
+    return ENCODERS[fmt](_event_chunks(funnel_id, start, end))
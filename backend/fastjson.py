@@ -0,0 +1,60 @@
+"""orjson-backed JSON responses.
+
+Handlers that return Mongo documents go through jsonable_encoder and the
+stdlib json module by default, which walks every element of a page tree
+twice in pure Python. FastJSONResponse serializes with orjson instead; naive
+datetimes come out as ISO 8601 strings exactly as jsonable_encoder writes
+them. Returning a FastJSONResponse from a handler also skips
+jsonable_encoder altogether.
+
+Run `python fastjson.py` to benchmark both paths on the largest templates.
+"""
+from decimal import Decimal
+import orjson
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+def _default(value):
+    # Types orjson does not handle natively; anything else (e.g. ObjectId) becomes a string
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    return str(value)
+
+def dumps(content) -> bytes:
+    return orjson.dumps(content, default=_default, option=OPTIONS)
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+def _benchmark(count: int = 5, rounds: int = 200):
+    import asyncio
+    import json
+    import timeit
+    from datetime import datetime
+    from fastapi.encoders import jsonable_encoder
+    import repository as repo
+
+    templates = asyncio.run(repo.list_templates())
+    largest = sorted(templates, key=lambda t: len(dumps(t)), reverse=True)[:count]
+    if not largest:
+        print("✗ No templates found; run the seed scripts first")
+        return
+    now = datetime.utcnow()
+    payloads = [(t["name"], dict(t, created_at=now, updated_at=now)) for t in largest]
+    payloads.append((f"(catalog, {len(templates)} templates)", templates))
+    print(f"{'payload':<36}{'bytes':>9}{'stdlib ms':>12}{'orjson ms':>12}{'speedup':>9}")
+    for name, payload in payloads:
+        stdlib = timeit.timeit(lambda: json.dumps(jsonable_encoder(payload)).encode(), number=rounds) / rounds
+        fast = timeit.timeit(lambda: dumps(payload), number=rounds) / rounds
+        print(f"{name[:35]:<36}{len(dumps(payload)):>9}{stdlib * 1000:>12.3f}"
+              f"{fast * 1000:>12.3f}{stdlib / fast:>8.1f}x")
+
+if __name__ == "__main__":
+    _benchmark()
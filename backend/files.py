@@ -0,0 +1,13 @@
+"""Shared helpers for the modules that keep per-funnel files on disk (publisher.py, archive.py)."""
+import asyncio
+import re
+
+# Funnel ids name directories, so only the characters of generated ids are accepted
+FUNNEL_ID = re.compile(r"^[A-Za-z0-9_-]+$")
+
+def valid_funnel_id(funnel_id) -> bool:
+    return isinstance(funnel_id, str) and FUNNEL_ID.match(funnel_id) is not None
+
+# File work runs in the default executor so it never blocks the event loop
+async def in_thread(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
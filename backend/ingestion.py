@@ -0,0 +1,151 @@
+"""Write-behind buffer for tracked analytics events.
+
+The tracking endpoint hands events to an EventBuffer and returns at once; a
+background task writes them to MongoDB in batches when the batch fills up or
+the flush interval passes. The buffer is bounded: when it is full, offer()
+returns False so the caller can shed load instead of growing memory.
+
+A batch that fails to write goes back to the front of the buffer and is
+retried with exponential backoff; its events only count as failed once
+TRACKING_MAX_RETRIES retries have failed. When only some events of a batch
+could not be inserted, the others are counted and only the failed ones are
+retried. Each event keeps the _id of its first insert attempt, so an event
+that was stored although the attempt reported an error is recognised by its
+duplicate key on the retry.
+"""
+import asyncio
+from collections import deque
+import os
+import repository as repo
+import rollups
+import uniques
+
+TRACKING_BUFFER_SIZE = int(os.getenv("TRACKING_BUFFER_SIZE", 100000))
+TRACKING_BATCH_SIZE = int(os.getenv("TRACKING_BATCH_SIZE", 1000))
+TRACKING_FLUSH_INTERVAL = float(os.getenv("TRACKING_FLUSH_INTERVAL", 0.5))
+TRACKING_MAX_RETRIES = int(os.getenv("TRACKING_MAX_RETRIES", 5))
+TRACKING_RETRY_DELAY = float(os.getenv("TRACKING_RETRY_DELAY", 0.5))
+
+# Last store_events step done for an event, so a retried batch does not store or count it twice
+STAGE = "_stage"
+
+class StoreError(Exception):
+    """Raised when some events of a batch could not be stored; only `events` need retrying"""
+    def __init__(self, events: list):
+        super().__init__(f"{len(events)} events could not be stored")
+        self.events = events
+
+async def store_events(events: list):
+    """Persist a flushed batch: raw events first, then the rollups and sketches derived from them"""
+    new = [event for event in events if STAGE not in event]
+    failed = await repo.insert_events(new) if new else set()
+    for index, event in enumerate(new):
+        if index not in failed:
+            event[STAGE] = "stored"
+    stored = [event for event in events if event.get(STAGE) == "stored"]
+    if stored:
+        await rollups.record_events(stored)
+        for event in stored:
+            event[STAGE] = "counted"
+    # Sketch registers are raised with $max, so repeating this step is harmless
+    await uniques.record_events([event for event in events if STAGE in event])
+    if failed:
+        raise StoreError([new[index] for index in sorted(failed)])
+
+class EventBuffer:
+    def __init__(self, writer, max_size=TRACKING_BUFFER_SIZE, batch_size=TRACKING_BATCH_SIZE,
+                 flush_interval=TRACKING_FLUSH_INTERVAL, max_retries=TRACKING_MAX_RETRIES,
+                 retry_delay=TRACKING_RETRY_DELAY):
+        self.writer = writer
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.retries = 0
+        self.flushed = 0
+        self.rejected = 0
+        self.failed = 0
+        self._events = deque()
+        self._wakeup = None
+        self._stopping = None
+        self._closing = False
+        self._task = None
+
+    def __len__(self):
+        return len(self._events)
+
+    def offer(self, event: dict) -> bool:
+        """Queue an event for writing; returns False when the buffer is full"""
+        if len(self._events) >= self.max_size:
+            self.rejected += 1
+            return False
+        self._events.append(event)
+        if len(self._events) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+        return True
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background writer and flush everything still queued"""
+        self._closing = True
+        if self._task is not None:
+            self._wakeup.set()
+            self._stopping.set()
+            await self._task
+            self._task = None
+        while not await self.flush():
+            await asyncio.sleep(self.backoff())
+
+    async def flush(self) -> bool:
+        """Write queued events in batches; False if a batch failed and was queued again for a retry"""
+        while self._events:
+            count = min(self.batch_size, len(self._events))
+            batch = [self._events.popleft() for _ in range(count)]
+            try:
+                await self.writer(batch)
+            except Exception as exc:
+                # After a partial failure only the events that were not stored are retried
+                pending = exc.events if isinstance(exc, StoreError) else batch
+                self.flushed += len(batch) - len(pending)
+                if self.retries >= self.max_retries:
+                    self.retries = 0
+                    self.failed += len(pending)
+                    print(f"✗ Dropped {len(pending)} analytics events after {self.max_retries} retries: {exc}")
+                    continue
+                self.retries += 1
+                self._requeue(pending)
+                print(f"✗ Failed to write {len(pending)} analytics events, retry {self.retries} "
+                      f"in {self.backoff():.1f}s: {exc}")
+                return False
+            self.retries = 0
+            self.flushed += len(batch)
+        return True
+
+    def _requeue(self, batch: list):
+        # Back at the front, in order; if new events filled the buffer meanwhile the newest are dropped
+        self._events.extendleft(reversed(batch))
+        while len(self._events) > self.max_size:
+            self._events.pop()
+            self.failed += 1
+
+    def backoff(self) -> float:
+        return self.retry_delay * 2 ** max(self.retries - 1, 0)
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not await self.flush():
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), self.backoff())
+                except asyncio.TimeoutError:
+                    pass
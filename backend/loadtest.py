@@ -0,0 +1,331 @@
+"""Load test for the FlowFunnels API.
+
+Boots the app in-process (startup and shutdown hooks included) and drives it
+through an ASGI transport, so results measure the application and its
+database rather than the network. By default the database is an in-memory
+MongoDB stand-in (mongomock-motor); pass --mongo-url to run against a real
+server, using a throwaway database (--database, dropped afterwards). The
+stand-in scans whole collections and blocks the event loop, so its numbers
+only compare with other stand-in runs; use --mongo-url for release
+comparisons. It also lacks arrayFilters, so page patches only run there.
+
+Each run seeds users, funnels cloned from generated templates, and
+analytics events, then runs --concurrency virtual users for --duration
+seconds. Each user picks weighted scenarios: login, funnel list, funnel and
+page fetch, autosave, template clone, tracking bursts and analytics reads.
+Throughput and p50/p95/p99 latency per route go to a JSON results file:
+
+    python loadtest.py --concurrency 32 --duration 30 --output loadtest-results.json
+
+Runs are reproducible for a given --seed; compare result files between
+releases to catch throughput regressions.
+"""
+import argparse
+import asyncio
+from collections import defaultdict
+from datetime import datetime, timedelta
+import json
+import os
+import platform
+import random
+import time
+import uuid
+
+os.environ.setdefault("SECRET_KEY", "loadtest-secret-key")
+
+import httpx
+import numpy as np
+import ingestion
+import repository as repo
+import server
+
+PASSWORD = "loadtest-password"
+
+SCENARIOS = {
+    "login": 2,
+    "list_funnels": 15,
+    "get_funnel": 10,
+    "get_page": 20,
+    "autosave_page": 10,
+    "patch_page": 5,
+    "clone_template": 2,
+    "list_templates": 5,
+    "track_burst": 20,
+    "funnel_analytics": 6,
+    "funnel_timeseries": 3,
+    "funnel_dropoff": 2,
+}
+
+# Database
+
+def bind_database(mongo_url: str = None, database: str = "flowfunnels_loadtest"):
+    """Point the repository (and everything built on it) at the load-test database"""
+    if mongo_url:
+        repo.connect(mongo_url, database)
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+        repo.connect(database=database, mongo_client=AsyncMongoMockClient())
+
+# Seed data
+
+def make_element(rng: random.Random, index: int) -> dict:
+    element_type = rng.choice(["heading", "text", "button", "image", "input", "email", "divider"])
+    return {
+        "id": f"el-{index}-{rng.randrange(10 ** 9)}",
+        "type": element_type,
+        "content": {"text": " ".join(rng.choice(["grow", "sell", "launch", "free", "offer", "now"])
+                                     for _ in range(rng.randint(3, 12))),
+                    "label": "Email", "placeholder": "you@example.com", "url": "#signup"},
+        "styles": {"fontSize": f"{rng.randint(12, 48)}px", "color": "#111827", "textAlign": "center",
+                   "padding": "12px", "marginTop": f"{rng.randint(0, 40)}px"},
+    }
+
+def make_template(rng: random.Random, pages: int, elements_per_page: int) -> dict:
+    template_pages = []
+    for page_index in range(pages):
+        columns = [
+            {"id": f"col-{page_index}-{c}", "width": 6,
+             "elements": [make_element(rng, e) for e in range(elements_per_page // 4)]}
+            for c in range(2)
+        ]
+        template_pages.append({
+            "name": f"Step {page_index + 1}",
+            "slug": f"step-{page_index + 1}",
+            "elements": [make_element(rng, e) for e in range(elements_per_page // 2)],
+            "sections": [{"id": f"sec-{page_index}", "styles": {"padding": "40px"},
+                          "rows": [{"id": f"row-{page_index}", "columns": columns}]}],
+            "styles": {"backgroundColor": "#ffffff"},
+            "seo_settings": {"title": f"Step {page_index + 1}", "description": "Load test page"},
+        })
+    return {
+        "id": str(uuid.uuid4()),
+        "name": f"Load Test Template {rng.randrange(10 ** 6)}",
+        "description": "Generated for load testing",
+        "category": "lead-generation",
+        "thumbnail": "",
+        "pages": template_pages,
+    }
+
+async def seed(client: httpx.AsyncClient, rng: random.Random, args) -> list:
+    """Create users with funnels cloned from templates, plus tracked history; returns user contexts"""
+    templates = [make_template(rng, args.template_pages, args.elements_per_page) for _ in range(args.templates)]
+    await repo.templates_collection.insert_many([dict(t) for t in templates])
+    await repo.bump_collection_version("templates")
+
+    users = []
+    for user_index in range(args.users):
+        email = f"loadtest-{user_index}@example.com"
+        response = await client.post("/api/auth/register",
+                                     json={"email": email, "password": PASSWORD, "name": f"User {user_index}"})
+        response.raise_for_status()
+        headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+        funnels = []
+        for _ in range(args.funnels_per_user):
+            template = rng.choice(templates)
+            response = await client.post(f"/api/templates/{template['id']}/clone", headers=headers)
+            response.raise_for_status()
+            funnels.append(response.json()["id"])
+        pages = {}
+        for funnel_id in funnels:
+            response = await client.get(f"/api/funnels/{funnel_id}", headers=headers)
+            pages[funnel_id] = response.json()["pages"]
+        users.append({"email": email, "headers": headers, "funnels": funnels, "pages": pages,
+                      "templates": [t["id"] for t in templates]})
+
+    # Historical events so analytics reads have something to aggregate
+    now = datetime.utcnow()
+    events = []
+    for user in users:
+        for funnel_id in user["funnels"]:
+            for _ in range(args.events_per_funnel):
+                page_ids = user["pages"][funnel_id]
+                events.append({
+                    "id": str(uuid.uuid4()),
+                    "funnel_id": funnel_id,
+                    "page_id": rng.choice(page_ids) if page_ids else None,
+                    "event_type": rng.choice(["page_view", "page_view", "button_click", "form_submit"]),
+                    "metadata": {"session_id": f"s{rng.randrange(args.events_per_funnel)}"},
+                    "timestamp": now - timedelta(minutes=rng.randrange(60 * 24 * args.history_days)),
+                })
+    for start in range(0, len(events), 5000):
+        await ingestion.store_events(events[start:start + 5000])
+    return users
+
+# Scenarios
+
+async def run_scenario(client: httpx.AsyncClient, rng: random.Random, user: dict, name: str, record):
+    headers = user["headers"]
+    funnel_id = rng.choice(user["funnels"])
+    page_ids = user["pages"][funnel_id]
+    page_id = rng.choice(page_ids) if page_ids else None
+
+    async def call(label, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            status_code = response.status_code
+        except Exception:
+            response, status_code = None, "exception"
+        record(label, time.perf_counter() - started, status_code)
+        return response
+
+    if name == "login":
+        await call("POST /api/auth/login", "POST", "/api/auth/login",
+                   json={"email": user["email"], "password": PASSWORD})
+    elif name == "list_funnels":
+        await call("GET /api/funnels", "GET", "/api/funnels", headers=headers, params={"view": "summary"})
+    elif name == "get_funnel":
+        await call("GET /api/funnels/{id}", "GET", f"/api/funnels/{funnel_id}", headers=headers)
+    elif name == "get_page" and page_id:
+        await call("GET /api/pages/{id}", "GET", f"/api/pages/{page_id}", headers=headers)
+    elif name == "autosave_page" and page_id:
+        page = await call("GET /api/pages/{id}", "GET", f"/api/pages/{page_id}", headers=headers)
+        if page is not None and page.status_code == 200:
+            body = page.json()
+            await call("PUT /api/pages/{id}", "PUT", f"/api/pages/{page_id}", headers=headers,
+                       json={"elements": body.get("elements"), "sections": body.get("sections")})
+    elif name == "patch_page" and page_id:
+        element = make_element(rng, 0)
+        await call("PATCH /api/pages/{id}", "PATCH", f"/api/pages/{page_id}", headers=headers,
+                   json={"operations": [{"op": "add", "element": element},
+                                        {"op": "update", "id": element["id"], "changes": {"styles.color": "#000"}},
+                                        {"op": "remove", "id": element["id"]}]})
+    elif name == "clone_template":
+        template_id = rng.choice(user["templates"])
+        await call("POST /api/templates/{id}/clone", "POST", f"/api/templates/{template_id}/clone", headers=headers)
+    elif name == "list_templates":
+        await call("GET /api/templates", "GET", "/api/templates")
+    elif name == "track_burst":
+        session_id = f"live-{rng.randrange(10 ** 9)}"
+        for step_page in page_ids or [None]:
+            await call("POST /api/analytics/track", "POST", "/api/analytics/track",
+                       json={"funnel_id": funnel_id, "page_id": step_page, "event_type": "page_view",
+                             "metadata": {"session_id": session_id}})
+    elif name == "funnel_analytics":
+        await call("GET /api/analytics/funnel/{id}", "GET", f"/api/analytics/funnel/{funnel_id}", headers=headers)
+    elif name == "funnel_timeseries":
+        await call("GET /api/analytics/funnel/{id}/timeseries", "GET",
+                   f"/api/analytics/funnel/{funnel_id}/timeseries", headers=headers,
+                   params={"granularity": rng.choice(["hour", "day", "week"])})
+    elif name == "funnel_dropoff":
+        await call("GET /api/analytics/funnel/{id}/dropoff", "GET",
+                   f"/api/analytics/funnel/{funnel_id}/dropoff", headers=headers)
+
+async def virtual_user(client, rng: random.Random, users: list, scenarios: dict, deadline: float, record):
+    names = list(scenarios)
+    weights = [scenarios[name] for name in names]
+    while time.perf_counter() < deadline:
+        name = rng.choices(names, weights)[0]
+        await run_scenario(client, rng, rng.choice(users), name, record)
+
+# Results
+
+def summarize(samples: dict, statuses: dict, elapsed: float) -> dict:
+    routes = {}
+    for label in sorted(samples):
+        latencies = np.array(samples[label]) * 1000
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        codes = statuses[label]
+        routes[label] = {
+            "requests": len(latencies),
+            "errors": sum(count for code, count in codes.items() if code == "exception" or code >= 400),
+            "status_codes": {str(code): count for code, count in sorted(codes.items(), key=str)},
+            "throughput_rps": round(len(latencies) / elapsed, 2),
+            "mean_ms": round(float(latencies.mean()), 3),
+            "p50_ms": round(float(p50), 3),
+            "p95_ms": round(float(p95), 3),
+            "p99_ms": round(float(p99), 3),
+            "max_ms": round(float(latencies.max()), 3),
+        }
+    total = sum(route["requests"] for route in routes.values())
+    return {
+        "requests": total,
+        "errors": sum(route["errors"] for route in routes.values()),
+        "throughput_rps": round(total / elapsed, 2),
+        "routes": routes,
+    }
+
+async def run(args) -> dict:
+    bind_database(args.mongo_url, args.database)
+    scenarios = dict(SCENARIOS)
+    if not args.mongo_url:
+        del scenarios["patch_page"]
+    rng = random.Random(args.seed)
+    transport = httpx.ASGITransport(app=server.app)
+    await server.app.router.startup()
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=60) as client:
+            seed_started = time.perf_counter()
+            users = await seed(client, rng, args)
+            seed_seconds = time.perf_counter() - seed_started
+            print(f"✓ Seeded {args.users} users and {args.users * args.funnels_per_user} funnels "
+                  f"in {seed_seconds:.1f}s")
+
+            samples = defaultdict(list)
+            statuses = defaultdict(lambda: defaultdict(int))
+
+            def record(label, seconds, status_code):
+                samples[label].append(seconds)
+                statuses[label][status_code] += 1
+
+            # Warm caches and connection pools before measuring
+            await asyncio.gather(*(
+                virtual_user(client, random.Random(args.seed + 1000 + i), users, scenarios,
+                             time.perf_counter() + args.warmup, lambda *a: None)
+                for i in range(args.concurrency)
+            ))
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                virtual_user(client, random.Random(args.seed + i), users, scenarios,
+                             started + args.duration, record)
+                for i in range(args.concurrency)
+            ))
+            elapsed = time.perf_counter() - started
+    finally:
+        await server.app.router.shutdown()
+        if args.mongo_url:
+            await repo.client.drop_database(args.database)
+
+    return {
+        "started_at": datetime.utcnow().isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "mongo_url")},
+        "scenarios": scenarios,
+        "database": "mongodb" if args.mongo_url else "mongomock",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed_seconds": round(seed_seconds, 3),
+        "duration_seconds": round(elapsed, 3),
+        **summarize(samples, statuses, elapsed),
+    }
+
+def print_report(results: dict):
+    print(f"{'route':<46}{'req':>8}{'err':>6}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for label, route in results["routes"].items():
+        print(f"{label:<46}{route['requests']:>8}{route['errors']:>6}{route['throughput_rps']:>9.1f}"
+              f"{route['p50_ms']:>9.2f}{route['p95_ms']:>9.2f}{route['p99_ms']:>9.2f}")
+    print(f"✓ {results['requests']} requests, {results['errors']} errors, "
+          f"{results['throughput_rps']} req/s over {results['duration_seconds']}s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the FlowFunnels API")
+    parser.add_argument("--concurrency", type=int, default=16, help="virtual users running at once")
+    parser.add_argument("--duration", type=float, default=20, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=2, help="unmeasured seconds before the run")
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--funnels-per-user", type=int, default=5)
+    parser.add_argument("--templates", type=int, default=5)
+    parser.add_argument("--template-pages", type=int, default=3)
+    parser.add_argument("--elements-per-page", type=int, default=24)
+    parser.add_argument("--events-per-funnel", type=int, default=50)
+    parser.add_argument("--history-days", type=int, default=7, help="spread seeded events over this many days")
+    parser.add_argument("--seed", type=int, default=42, help="random seed for data and scenario choice")
+    parser.add_argument("--mongo-url", help="run against this MongoDB instead of the in-memory stand-in")
+    parser.add_argument("--database", default="flowfunnels_loadtest", help="database to create and drop")
+    parser.add_argument("--output", default="loadtest-results.json", help="results file (JSON)")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print_report(results)
+    print(f"✓ Results written to {args.output}")
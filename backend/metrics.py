@@ -0,0 +1,219 @@
+"""Prometheus-style metrics.
+
+MetricsMiddleware times every request by route template and counts the
+MongoDB commands it issues: command_listener is registered on the Mongo
+client, and motor runs each command in a copy of the request's context, so
+commands are attributed to the request that made them. Point-in-time values
+(cache sizes, queue depth) are registered as callback gauges and read when
+/api/metrics is scraped. Metrics are kept per process.
+
+boot_timer measures cold start: server.py imports this module first, and
+the time from then to the end of the imports, of the startup hook and of the
+first response is exported as flowfunnels_boot_seconds.
+"""
+import contextvars
+import threading
+import time
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+# Labels for routes that did not match, so unknown paths cannot blow up cardinality
+UNMATCHED_ROUTE = "unmatched"
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values: tuple, amount: float = 1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in sorted(self.values.items()):
+            yield f"{self.name}{_labels(self.labels, label_values)} {_number(value)}"
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values: tuple, value: float):
+        with self._lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for label_values, (counts, total, count) in sorted(self.values.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield (f"{self.name}_bucket"
+                       f"{_labels(self.labels + ('le',), label_values + (_number(bound),))} {bucket_count}")
+            yield f"{self.name}_bucket{_labels(self.labels + ('le',), label_values + ('+Inf',))} {count}"
+            yield f"{self.name}_sum{_labels(self.labels, label_values)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.labels, label_values)} {count}"
+
+class Callback:
+    """Values read at scrape time; read() returns {label values: value}"""
+    def __init__(self, name: str, help: str, labels: tuple, read, kind: str = "gauge"):
+        self.name, self.help, self.labels, self.read, self.kind = name, help, labels, read, kind
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for label_values, value in sorted(self.read().items()):
+            yield f"{self.name}{_labels(self.labels, label_values)} {_number(value)}"
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# Registry
+REGISTRY = []
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+def gauge(name: str, help: str, read, labels: tuple = ()):
+    return register(Callback(name, help, labels, read))
+
+def counter_callback(name: str, help: str, read, labels: tuple = ()):
+    """A counter kept elsewhere (e.g. cache hit counts), read at scrape time"""
+    return register(Callback(name, help, labels, read, kind="counter"))
+
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+http_requests = register(Counter(
+    "flowfunnels_http_requests_total", "HTTP requests by route and status", ("method", "route", "status")))
+http_latency = register(Histogram(
+    "flowfunnels_http_request_duration_seconds", "HTTP request latency by route", ("method", "route")))
+request_db_operations = register(Histogram(
+    "flowfunnels_http_request_db_operations", "MongoDB commands issued per request",
+    ("method", "route"), COUNT_BUCKETS))
+route_db_operations = register(Counter(
+    "flowfunnels_route_db_operations_total", "MongoDB commands issued by requests, by route",
+    ("method", "route", "collection", "command")))
+mongo_commands = register(Counter(
+    "flowfunnels_mongo_commands_total", "MongoDB commands by collection and command",
+    ("collection", "command", "outcome")))
+mongo_latency = register(Histogram(
+    "flowfunnels_mongo_command_duration_seconds", "MongoDB command latency", ("command",)))
+
+# Cold start
+
+class BootTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase: str) -> bool:
+        """Record when a phase finished; False if it already had"""
+        if phase in self.phases:
+            return False
+        self.phases[phase] = time.perf_counter() - self.started
+        return True
+
+boot_timer = BootTimer()
+gauge("flowfunnels_boot_seconds", "Seconds from the start of the server import to each boot phase",
+      lambda: {(phase,): seconds for phase, seconds in boot_timer.phases.items()}, labels=("phase",))
+
+# MongoDB command monitoring
+
+# The (collection, command) list of the request being served, if any
+_request_commands = contextvars.ContextVar("request_commands", default=None)
+
+def command_collection(event) -> str:
+    value = event.command.get(event.command_name)
+    if event.command_name == "getMore":
+        value = event.command.get("collection")
+    return value if isinstance(value, str) else "-"
+
+class CommandListener(monitoring.CommandListener):
+    def __init__(self):
+        self._started = {}
+
+    def started(self, event):
+        collection = command_collection(event)
+        self._started[(event.connection_id, event.request_id)] = collection
+        commands = _request_commands.get()
+        if commands is not None:
+            commands.append((collection, event.command_name))
+
+    def _finished(self, event, outcome: str):
+        collection = self._started.pop((event.connection_id, event.request_id), "-")
+        mongo_commands.inc((collection, event.command_name, outcome))
+        mongo_latency.observe((event.command_name,), event.duration_micros / 1e6)
+
+    def succeeded(self, event):
+        self._finished(event, "success")
+
+    def failed(self, event):
+        self._finished(event, "failure")
+
+command_listener = CommandListener()
+
+# HTTP middleware
+
+def route_label(scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", UNMATCHED_ROUTE)
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, status and MongoDB commands per route"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = {"code": 500, "elapsed": None}
+        commands = []
+        token = _request_commands.set(commands)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            elif message["type"] == "http.response.body" and not message.get("more_body"):
+                status["elapsed"] = time.perf_counter() - started
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_commands.reset(token)
+            # Commands from background tasks run after the response still count for the request
+            method, route = scope["method"], route_label(scope)
+            elapsed = status["elapsed"] if status["elapsed"] is not None else time.perf_counter() - started
+            http_requests.inc((method, route, str(status["code"])))
+            http_latency.observe((method, route), elapsed)
+            request_db_operations.observe((method, route), len(commands))
+            for collection, command in commands:
+                route_db_operations.inc((method, route, collection, command))
+            if boot_timer.mark("first_request"):
+                phases = boot_timer.phases
+                print(f"✓ First request served {phases['first_request']:.2f}s after import started "
+                      f"(import {phases.get('import', 0):.2f}s, startup done at {phases.get('startup', 0):.2f}s)")
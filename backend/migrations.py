@@ -0,0 +1,177 @@
+"""Index bootstrap and schema migrations for FlowFunnels collections.
+
+Indexes are declared once here and applied idempotently on startup. Run
+this file directly to apply indexes and pending migrations, or with
+--report to list missing, undeclared and unused indexes.
+"""
+import argparse
+import asyncio
+from datetime import datetime
+from pymongo import ASCENDING, UpdateMany
+from pymongo.errors import OperationFailure
+import repository as repo
+import rollups
+
+# Required indexes per collection: (name, keys, options)
+INDEXES = {
+    "users": [
+        ("email_unique", [("email", ASCENDING)], {"unique": True}),
+        ("id_unique", [("id", ASCENDING)], {"unique": True}),
+    ],
+    "funnels": [
+        ("id_unique", [("id", ASCENDING)], {"unique": True}),
+        ("user_id_id", [("user_id", ASCENDING), ("id", ASCENDING)], {}),
+        ("user_id_updated_at_id", [("user_id", ASCENDING), ("updated_at", ASCENDING), ("id", ASCENDING)], {}),
+        ("user_id_created_at_id", [("user_id", ASCENDING), ("created_at", ASCENDING), ("id", ASCENDING)], {}),
+        ("id_published", [("id", ASCENDING), ("published", ASCENDING)], {}),
+    ],
+    "pages": [
+        ("id_unique", [("id", ASCENDING)], {"unique": True}),
+        ("funnel_id", [("funnel_id", ASCENDING)], {}),
+        ("funnel_id_slug", [("funnel_id", ASCENDING), ("slug", ASCENDING)], {}),
+    ],
+    "analytics": [
+        ("funnel_id_event_type_timestamp",
+         [("funnel_id", ASCENDING), ("event_type", ASCENDING), ("timestamp", ASCENDING)], {}),
+        # Exports read a funnel's events in time order
+        ("funnel_id_timestamp", [("funnel_id", ASCENDING), ("timestamp", ASCENDING)], {}),
+        # Drop-off analysis walks each visitor session in time order
+        ("funnel_id_session_id_timestamp",
+         [("funnel_id", ASCENDING), ("metadata.session_id", ASCENDING), ("timestamp", ASCENDING)],
+         {"partialFilterExpression": {"metadata.session_id": {"$exists": True}}}),
+    ],
+    "analytics_rollups": [
+        ("funnel_id_granularity_bucket_page_id_event_type",
+         [("funnel_id", ASCENDING), ("granularity", ASCENDING), ("bucket", ASCENDING),
+          ("page_id", ASCENDING), ("event_type", ASCENDING)], {"unique": True}),
+    ],
+    "analytics_uniques": [
+        ("funnel_id_page_id_day", [("funnel_id", ASCENDING), ("page_id", ASCENDING), ("day", ASCENDING)],
+         {"unique": True}),
+    ],
+    "analytics_archive": [
+        ("funnel_id_unique", [("funnel_id", ASCENDING)], {"unique": True}),
+    ],
+    "templates": [
+        ("id_unique", [("id", ASCENDING)], {"unique": True}),
+    ],
+}
+
+# One-off data migrations, applied in order and recorded in schema_migrations.
+# They run in the startup hook, so they must be quick and safe while events
+# are being tracked; the rollups backfill runs in the background (rollups.py).
+MIGRATIONS = []
+
+def migration(name):
+    """Register a data migration under a unique, never-reused name"""
+    def register(func):
+        MIGRATIONS.append((name, func))
+        return func
+    return register
+
+@migration("0001_pages_user_id")
+async def backfill_page_owners(db):
+    """Copy each funnel's user_id onto its pages"""
+    operations = []
+    async for funnel in db.funnels.find({}, {"_id": 0, "id": 1, "user_id": 1}):
+        operations.append(UpdateMany(
+            {"funnel_id": funnel["id"], "user_id": {"$exists": False}},
+            {"$set": {"user_id": funnel["user_id"]}}
+        ))
+        if len(operations) == 1000:
+            await db.pages.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        await db.pages.bulk_write(operations, ordered=False)
+
+@migration("0002_pages_element_trees")
+async def backfill_element_trees(db):
+    """Make sure every page has both element trees so patches can target either"""
+    await db.pages.update_many({"elements": {"$exists": False}}, {"$set": {"elements": []}})
+    await db.pages.update_many({"sections": {"$exists": False}}, {"$set": {"sections": []}})
+
+@migration("0003_analytics_rollups")
+async def start_analytics_rollups(db):
+    """Start counting tracked events into rollups; earlier events are backfilled after startup"""
+    await rollups.start_live_counting()
+
+async def _ensure_collection_indexes(db, collection_name: str, indexes: list) -> list:
+    collection = db[collection_name]
+    existing = await collection.index_information()
+    created = []
+    for name, keys, options in indexes:
+        if name in existing:
+            continue
+        try:
+            await collection.create_index(keys, name=name, **options)
+        except OperationFailure as exc:
+            print(f"✗ Could not create index {collection_name}.{name}: {exc}")
+            continue
+        created.append(f"{collection_name}.{name}")
+    return created
+
+async def ensure_indexes(db=None):
+    """Create any missing declared indexes; existing ones are left untouched"""
+    db = repo.db if db is None else db
+    # Collections are checked concurrently, so a warm start costs one round trip rather than one per collection
+    results = await asyncio.gather(*(
+        _ensure_collection_indexes(db, collection_name, indexes) for collection_name, indexes in INDEXES.items()
+    ))
+    return [name for created in results for name in created]
+
+async def index_report(db=None):
+    """Compare declared indexes with what exists and how often each is used"""
+    db = repo.db if db is None else db
+    report = {"missing": [], "undeclared": [], "unused": []}
+    for collection_name, indexes in INDEXES.items():
+        collection = db[collection_name]
+        declared = {name for name, _, _ in indexes}
+        existing = await collection.index_information()
+        report["missing"] += [f"{collection_name}.{name}" for name in declared if name not in existing]
+        report["undeclared"] += [
+            f"{collection_name}.{name}" for name in existing if name != "_id_" and name not in declared
+        ]
+        try:
+            stats = await collection.aggregate([{"$indexStats": {}}]).to_list(length=None)
+        except OperationFailure:
+            continue
+        report["unused"] += [
+            f"{collection_name}.{s['name']}" for s in stats
+            if s["name"] != "_id_" and s["accesses"]["ops"] == 0
+        ]
+    return report
+
+async def run_migrations(db=None):
+    """Apply registered migrations that have not run yet"""
+    db = repo.db if db is None else db
+    applied = {m["name"] async for m in db.schema_migrations.find({}, {"name": 1})}
+    ran = []
+    for name, func in MIGRATIONS:
+        if name in applied:
+            continue
+        await func(db)
+        await db.schema_migrations.insert_one({"name": name, "applied_at": datetime.utcnow()})
+        ran.append(name)
+    return ran
+
+async def main(report_only=False):
+    if report_only:
+        report = await index_report()
+        for kind, names in report.items():
+            print(f"{kind.capitalize()} indexes: {', '.join(names) if names else 'none'}")
+        return
+
+    created = await ensure_indexes()
+    for name in created:
+        print(f"✓ Created index: {name}")
+    ran = await run_migrations()
+    for name in ran:
+        print(f"✓ Applied migration: {name}")
+    if not created and not ran:
+        print("Schema is up to date")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply FlowFunnels indexes and migrations")
+    parser.add_argument("--report", action="store_true", help="only report missing/undeclared/unused indexes")
+    args = parser.parse_args()
+    asyncio.run(main(report_only=args.report))
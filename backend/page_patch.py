@@ -0,0 +1,173 @@
+"""Element-level patches for page trees.
+
+A page keeps its elements either in the flat `elements` list or nested in
+`sections -> rows -> columns -> elements`. Patch operations address elements
+by their `id` and are translated into targeted array updates, so an edit
+rewrites one element instead of the whole tree:
+
+- add:    {"op": "add", "element": {...}, "parent_id": column id, "index": n}
+- update: {"op": "update", "id": element id, "changes": {"field": value}}
+- remove: {"op": "remove", "id": element id}
+- move:   {"op": "move", "id": element id, "parent_id": column id, "index": n}
+
+Without parent_id, add and move target the flat `elements` list. Each write
+only matches the page while its element (or parent column) is there, so an
+unknown id is reported as an error instead of silently doing nothing. Element
+ids are unique per page: adding an id that is already there is a conflict.
+Operations are applied in order; a patch is not atomic across operations,
+and updated_at is only bumped once every operation has been applied.
+"""
+from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+import repository as repo
+
+FLAT_ELEMENTS = "elements"
+NESTED_ELEMENTS = "sections.$[].rows.$[].columns.$[].elements"
+NESTED_COLUMNS = "sections.rows.columns"
+
+class PatchError(ValueError):
+    """Raised for a malformed patch operation or a missing element"""
+
+class PatchConflict(PatchError):
+    """Raised when an added element's id is already on the page"""
+
+# Writes are (update, array_filters, condition); the condition is added to the page query
+
+def _holds(element_id):
+    return {"$or": [{f"{FLAT_ELEMENTS}.id": element_id}, {f"{NESTED_COLUMNS}.elements.id": element_id}]}
+
+def _lacks(element_id):
+    return {f"{FLAT_ELEMENTS}.id": {"$ne": element_id}, f"{NESTED_COLUMNS}.elements.id": {"$ne": element_id}}
+
+def _container(parent_id):
+    if parent_id is None:
+        return FLAT_ELEMENTS, None, {}
+    return "sections.$[].rows.$[].columns.$[col].elements", [{"col.id": parent_id}], {f"{NESTED_COLUMNS}.id": parent_id}
+
+def _push(element, parent_id, index):
+    path, array_filters, condition = _container(parent_id)
+    push = {"$each": [element]}
+    if index is not None:
+        push["$position"] = index
+    # Also guards against a concurrent patch adding the same id
+    return {"$push": {path: push}}, array_filters, {**condition, **_lacks(element["id"])}
+
+def _pull(element_id):
+    # $pull is a no-op on whichever tree does not hold the element
+    return {"$pull": {FLAT_ELEMENTS: {"id": element_id}, NESTED_ELEMENTS: {"id": element_id}}}, None, _holds(element_id)
+
+def _set(element_id, changes):
+    fields = {}
+    for key, value in changes.items():
+        if not key or "$" in key or key == "id":
+            raise PatchError(f"Invalid field in changes: {key!r}")
+        fields[f"{FLAT_ELEMENTS}.$[el].{key}"] = value
+        fields[f"{NESTED_ELEMENTS}.$[el].{key}"] = value
+    return {"$set": fields}, [{"el.id": element_id}], _holds(element_id)
+
+def _elements(page):
+    yield from page.get("elements") or []
+    for section in page.get("sections") or []:
+        for row in section.get("rows") or []:
+            for column in row.get("columns") or []:
+                yield from column.get("elements") or []
+
+def _find_element(page, element_id):
+    for element in _elements(page):
+        if element.get("id") == element_id:
+            return element
+    return None
+
+def _check_added_ids(page, operations):
+    """Raise PatchConflict if an add would duplicate an id on the page, following the patch in order"""
+    ids = {element.get("id") for element in _elements(page)}
+    for operation in operations:
+        if operation["op"] == "add":
+            element_id = operation["element"]["id"]
+            if element_id in ids:
+                raise PatchConflict(f"Element already exists: {element_id}")
+            ids.add(element_id)
+        elif operation["op"] == "remove":
+            ids.discard(operation["id"])
+
+def _has_column(page, column_id) -> bool:
+    return any(
+        column.get("id") == column_id
+        for section in page.get("sections") or []
+        for row in section.get("rows") or []
+        for column in row.get("columns") or []
+    )
+
+def _plan(operations):
+    """Validate operations and translate them into writes; moves are resolved later"""
+    steps = []
+    for operation in operations:
+        op = operation.get("op")
+        element_id = operation.get("id")
+        if op == "add":
+            element = operation.get("element")
+            if not isinstance(element, dict) or not element.get("id"):
+                raise PatchError("add requires an element with an id")
+            steps.append(_push(element, operation.get("parent_id"), operation.get("index")))
+        elif op == "update":
+            if not element_id or not operation.get("changes"):
+                raise PatchError("update requires id and changes")
+            steps.append(_set(element_id, operation["changes"]))
+        elif op == "remove":
+            if not element_id:
+                raise PatchError("remove requires id")
+            steps.append(_pull(element_id))
+        elif op == "move":
+            if not element_id:
+                raise PatchError("move requires id")
+            steps.append(operation)
+        else:
+            raise PatchError(f"Unknown operation: {op!r}")
+    return steps
+
+async def apply_page_patch(page_id: str, user_id: str, operations: list):
+    """Apply patch operations to an owned page; returns its funnel_id or None"""
+    steps = _plan(operations)
+    funnel_id = await repo.get_page_funnel_id(page_id, user_id)
+    if funnel_id is None:
+        return None
+    if any(operation["op"] == "add" for operation in operations):
+        _check_added_ids(await repo.get_page_tree(page_id, user_id) or {}, operations)
+
+    pending = []
+    for step in steps:
+        if isinstance(step, tuple):
+            pending.append(step)
+            continue
+        # A move re-inserts the element's current value, so earlier writes go first
+        await _write(page_id, user_id, pending)
+        pending = []
+        page = await repo.get_page_tree(page_id, user_id) or {}
+        element = _find_element(page, step["id"])
+        if element is None:
+            raise PatchError(f"Element not found: {step['id']}")
+        # Checked before the element is pulled, so a bad target cannot lose it
+        if step.get("parent_id") is not None and not _has_column(page, step["parent_id"]):
+            raise PatchError(f"Parent not found: {step['parent_id']}")
+        pending.append(_pull(step["id"]))
+        pending.append(_push(element, step.get("parent_id"), step.get("index")))
+    await _write(page_id, user_id, pending)
+    await repo.touch_page(page_id, user_id, datetime.utcnow())
+    return funnel_id
+
+async def _write(page_id, user_id, pending):
+    if not pending:
+        return
+    query = {"id": page_id, "user_id": user_id}
+    requests = [
+        UpdateOne({**query, **condition}, update, array_filters=array_filters)
+        for update, array_filters, condition in pending
+    ]
+    try:
+        matched = await repo.bulk_update_page(requests)
+    except BulkWriteError as exc:
+        errors = exc.details.get("writeErrors") or [{}]
+        raise PatchError(errors[0].get("errmsg", "Patch could not be applied"))
+    if matched < len(requests):
+        raise PatchError(f"{len(requests) - matched} operation(s) matched no element or parent column")
@@ -0,0 +1,65 @@
+"""Password hashing off the event loop.
+
+bcrypt costs 100-300ms of CPU per call, so hashing and verification run in a
+dedicated thread pool (bcrypt releases the GIL). At most
+PASSWORD_HASH_QUEUE_LIMIT calls may be waiting or running at once; beyond
+that HasherBusy is raised so a login storm is shed instead of queueing
+without bound. The CryptContext (passlib and its bcrypt backend) is only
+loaded on first use, or by warm_up() in the background after startup.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv("PASSWORD_HASH_QUEUE_LIMIT", PASSWORD_HASH_WORKERS * 8))
+
+_context = None
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+_pending = 0
+
+class HasherBusy(Exception):
+    """Raised when too many password hash operations are already queued"""
+
+def context():
+    global _context
+    if _context is None:
+        from passlib.context import CryptContext
+        # Hashes made with a different cost are upgraded on the next successful login
+        _context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+    return _context
+
+def _hash(password: str) -> str:
+    return context().hash(password)
+
+def _verify(plain_password: str, hashed_password: str):
+    return context().verify_and_update(plain_password, hashed_password)
+
+async def _run(func, *args):
+    global _pending
+    if _pending >= PASSWORD_HASH_QUEUE_LIMIT:
+        raise HasherBusy()
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+    finally:
+        _pending -= 1
+
+async def hash_password(password: str) -> str:
+    return await _run(_hash, password)
+
+async def verify_password(plain_password: str, hashed_password: str):
+    """Return (valid, new_hash); new_hash is set when the stored hash needs an upgrade"""
+    return await _run(_verify, plain_password, hashed_password)
+
+async def warm_up():
+    """Load passlib and the bcrypt backend off the event loop"""
+    await asyncio.get_running_loop().run_in_executor(_executor, lambda: context().handler().get_backend())
+
+def pending() -> int:
+    """Hash operations currently waiting or running"""
+    return _pending
+
+def shutdown():
+    _executor.shutdown(wait=False)
@@ -0,0 +1,159 @@
+"""Publish funnels as immutable static artifacts.
+
+Publishing renders every page of a funnel to content-hashed files under
+PUBLISH_ARTIFACT_DIR (a local stand-in for an object store):
+
+    {funnel_id}/assets/{slug}.{hash}.html   immutable, cacheable forever
+    {funnel_id}/assets/styles.{hash}.css
+    {funnel_id}/versions/{version}.json     manifest: slug -> asset
+    {funnel_id}/current.json                copy of the live manifest
+
+A version goes live by atomically replacing current.json, so visitors see
+either the old or the new version, never a mix. Rolling back rewrites
+current.json from an earlier manifest; assets are never overwritten.
+"""
+from datetime import datetime
+import hashlib
+import json
+import os
+import re
+from files import in_thread, valid_funnel_id
+import renderer
+
+PUBLISH_ARTIFACT_DIR = os.path.abspath(os.getenv("PUBLISH_ARTIFACT_DIR", "published"))
+STATIC_URL_PREFIX = "/static"
+
+ASSET_NAME = re.compile(r"^[A-Za-z0-9_-]+\.[0-9a-f]{16}\.(html|css)$")
+
+# Parsed current.json per funnel, keyed by file mtime
+_manifests = {}
+
+class PublishError(Exception):
+    """Raised when there is nothing to publish or roll back to"""
+
+def _funnel_dir(funnel_id: str) -> str:
+    if not valid_funnel_id(funnel_id):
+        raise PublishError("Invalid funnel id")
+    return os.path.join(PUBLISH_ARTIFACT_DIR, funnel_id)
+
+def _write_atomic(path: str, data: bytes):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _write_asset(assets_dir: str, stem: str, ext: str, data: bytes) -> str:
+    name = f"{stem}.{hashlib.sha256(data).hexdigest()[:16]}.{ext}"
+    path = os.path.join(assets_dir, name)
+    if not os.path.exists(path):
+        _write_atomic(path, data)
+    return name
+
+def _publish(funnel_id: str, pages: list) -> dict:
+    funnel_dir = _funnel_dir(funnel_id)
+    assets_dir = os.path.join(funnel_dir, "assets")
+    versions_dir = os.path.join(funnel_dir, "versions")
+    os.makedirs(assets_dir, exist_ok=True)
+    os.makedirs(versions_dir, exist_ok=True)
+
+    stylesheet = _write_asset(assets_dir, "styles", "css", renderer.BASE_CSS.encode())
+    stylesheet_href = f"{STATIC_URL_PREFIX}/{funnel_id}/{stylesheet}"
+    files = {}
+    for page in pages:
+        body = renderer.render_page(page, stylesheet_href=stylesheet_href).encode()
+        stem = re.sub(r"[^A-Za-z0-9_-]", "-", page["slug"]) or "page"
+        files[page["slug"]] = _write_asset(assets_dir, stem, "html", body)
+
+    digest = hashlib.sha256(json.dumps(files, sort_keys=True).encode()).hexdigest()[:8]
+    manifest = {
+        "funnel_id": funnel_id,
+        "version": f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{digest}",
+        "published_at": datetime.utcnow().isoformat(),
+        "stylesheet": stylesheet,
+        "pages": files,
+    }
+    data = json.dumps(manifest, indent=2).encode()
+    _write_atomic(os.path.join(versions_dir, f"{manifest['version']}.json"), data)
+    _write_atomic(os.path.join(funnel_dir, "current.json"), data)
+    return manifest
+
+def _list_versions(funnel_id: str) -> list:
+    versions_dir = os.path.join(_funnel_dir(funnel_id), "versions")
+    if not os.path.isdir(versions_dir):
+        return []
+    return sorted(name[:-5] for name in os.listdir(versions_dir) if name.endswith(".json"))
+
+def _rollback(funnel_id: str, version: str = None) -> dict:
+    versions = _list_versions(funnel_id)
+    current = _current_manifest(funnel_id)
+    if version is None:
+        # Default to the version published just before the live one
+        older = [v for v in versions if current is None or v < current["version"]]
+        if not older:
+            raise PublishError("No earlier version to roll back to")
+        version = older[-1]
+    if version not in versions:
+        raise PublishError(f"Unknown version: {version}")
+    funnel_dir = _funnel_dir(funnel_id)
+    with open(os.path.join(funnel_dir, "versions", f"{version}.json"), "rb") as f:
+        data = f.read()
+    _write_atomic(os.path.join(funnel_dir, "current.json"), data)
+    return json.loads(data)
+
+def _unpublish(funnel_id: str):
+    try:
+        os.remove(os.path.join(_funnel_dir(funnel_id), "current.json"))
+    except FileNotFoundError:
+        pass
+    _manifests.pop(funnel_id, None)
+
+def _current_manifest(funnel_id: str):
+    """Return the live manifest for a funnel, or None if it is not published"""
+    try:
+        path = os.path.join(_funnel_dir(funnel_id), "current.json")
+        mtime = os.stat(path).st_mtime_ns
+    except (OSError, PublishError):
+        return None
+    cached = _manifests.get(funnel_id)
+    if cached is None or cached[0] != mtime:
+        with open(path, "rb") as f:
+            cached = (mtime, json.load(f))
+        _manifests[funnel_id] = cached
+    return cached[1]
+
+def _asset_path(funnel_id: str, name: str):
+    """Resolve a published asset file, or None for unknown or unsafe names"""
+    if not ASSET_NAME.match(name):
+        return None
+    try:
+        path = os.path.join(_funnel_dir(funnel_id), "assets", name)
+    except PublishError:
+        return None
+    return path if os.path.isfile(path) else None
+
+def _page_asset(funnel_id: str, slug: str):
+    manifest = _current_manifest(funnel_id)
+    if manifest is None or slug not in manifest["pages"]:
+        return None
+    return _asset_path(funnel_id, manifest["pages"][slug])
+
+async def current_manifest(funnel_id: str):
+    return await in_thread(_current_manifest, funnel_id)
+
+async def asset_path(funnel_id: str, name: str):
+    return await in_thread(_asset_path, funnel_id, name)
+
+async def page_asset(funnel_id: str, slug: str):
+    return await in_thread(_page_asset, funnel_id, slug)
+
+async def publish_funnel(funnel_id: str, pages: list) -> dict:
+    return await in_thread(_publish, funnel_id, pages)
+
+async def rollback_funnel(funnel_id: str, version: str = None) -> dict:
+    return await in_thread(_rollback, funnel_id, version)
+
+async def unpublish_funnel(funnel_id: str):
+    await in_thread(_unpublish, funnel_id)
+
+async def list_versions(funnel_id: str) -> list:
+    return await in_thread(_list_versions, funnel_id)
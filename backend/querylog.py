@@ -0,0 +1,179 @@
+"""Slow-query log and N+1 detector for MongoDB access.
+
+query_listener is registered on the Mongo client next to the metrics
+listener. It reduces every command's filter to its shape (field names and
+operators, with values replaced by their type) and:
+
+- prints commands slower than SLOW_QUERY_MS with their shape and route;
+- counts shapes per request (QueryLogMiddleware) and flags requests that
+  issue the same shape N_PLUS_ONE_THRESHOLD or more times, e.g. one
+  insert_one per page in a loop;
+- explains each new filtered (collection, command, shape) once, in a
+  background thread, and warns when the winning plan is a collection scan.
+"""
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import os
+import threading
+from pymongo import MongoClient, monitoring
+from metrics import command_collection, route_label
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 100))
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", 5))
+QUERY_PLAN_CHECK = os.getenv("QUERY_PLAN_CHECK", "true").lower() == "true"
+
+# Where each command keeps its filter
+FILTER_FIELDS = {"find": "filter", "count": "query", "distinct": "query", "findAndModify": "query"}
+EXPLAINABLE = {"find", "count", "distinct", "aggregate", "findAndModify", "update", "delete"}
+
+# Command fields that belong to the session or connection, not the query
+SESSION_FIELDS = {"lsid", "txnNumber", "autocommit", "startTransaction", "readConcern", "writeConcern", "$db",
+                  "$clusterTime", "$readPreference", "apiVersion", "apiStrict", "apiDeprecationErrors"}
+
+# Shapes
+
+def shape(value):
+    """Structure of a filter with its values replaced by their type names"""
+    if isinstance(value, dict):
+        return {key: shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        # $in / $and lists are shaped by their first item so their length does not matter
+        return [shape(value[0])] if value else []
+    return type(value).__name__
+
+def command_filter(command_name: str, command: dict):
+    if command_name in FILTER_FIELDS:
+        return command.get(FILTER_FIELDS[command_name])
+    if command_name == "aggregate":
+        return [stage for stage in command.get("pipeline", []) if "$match" in stage][:1] or None
+    if command_name in ("update", "delete"):
+        statements = command.get("updates" if command_name == "update" else "deletes") or [{}]
+        return statements[0].get("q")
+    return None
+
+def command_shape(event) -> str:
+    return _format(shape(command_filter(event.command_name, event.command) or {}))
+
+def _format(value) -> str:
+    if isinstance(value, dict):
+        return "{" + ", ".join(f"{key}: {_format(item)}" for key, item in value.items()) + "}"
+    if isinstance(value, list):
+        return "[" + ", ".join(_format(item) for item in value) + "]"
+    return value
+
+# Query plans
+
+def _has_collscan(plan) -> bool:
+    if isinstance(plan, dict):
+        return plan.get("stage") == "COLLSCAN" or any(_has_collscan(item) for item in plan.values())
+    if isinstance(plan, list):
+        return any(_has_collscan(item) for item in plan)
+    return False
+
+class PlanChecker:
+    """Explains each new query shape once on a separate client and warns about collection scans"""
+    def __init__(self, mongo_url: str = None):
+        self.mongo_url = mongo_url
+        self.checked = set()
+        self.reset()
+
+    def reset(self):
+        """Drop the client, lock and worker thread; a forked process must not reuse its parent's"""
+        self._lock = threading.Lock()
+        self._client = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="query-plans")
+
+    def submit(self, event, collection: str, query_shape: str, route: str):
+        key = (event.database_name, collection, event.command_name, query_shape)
+        with self._lock:
+            if key in self.checked:
+                return
+            self.checked.add(key)
+        command = {name: value for name, value in event.command.items() if name not in SESSION_FIELDS}
+        self._executor.submit(self._check, event.database_name, command, key, route)
+
+    def _check(self, database: str, command: dict, key: tuple, route: str):
+        try:
+            if self._client is None:
+                # No listeners on this client, so explains are not checked or counted themselves
+                self._client = MongoClient(self.mongo_url or os.getenv("MONGO_URL"))
+            plan = self._client[database].command("explain", command, verbosity="queryPlanner")
+        except Exception as exc:
+            print(f"✗ Could not explain {key[2]} on {key[1]}: {exc}")
+            return
+        planner = plan.get("queryPlanner") or plan.get("stages", [{}])[0].get("$cursor", {}).get("queryPlanner", {})
+        if _has_collscan(planner.get("winningPlan")):
+            print(f"⚠ Collection scan: {key[2]} {key[1]} {key[3]} (route {route}); no index matches this filter")
+
+plan_checker = PlanChecker()
+os.register_at_fork(after_in_child=plan_checker.reset)
+
+# Command monitoring
+
+# Counter of (collection, command, shape) for the request being served, if any
+_request_shapes = contextvars.ContextVar("request_shapes", default=None)
+_request_scope = contextvars.ContextVar("request_scope", default=None)
+
+def current_route() -> str:
+    scope = _request_scope.get()
+    return f"{scope['method']} {route_label(scope)}" if scope else "-"
+
+class QueryListener(monitoring.CommandListener):
+    def __init__(self):
+        self._started = {}
+
+    def started(self, event):
+        if event.command_name not in EXPLAINABLE and event.command_name != "insert":
+            return
+        collection = command_collection(event)
+        query_shape = command_shape(event)
+        route = current_route()
+        self._started[(event.connection_id, event.request_id)] = (collection, query_shape, route)
+        shapes = _request_shapes.get()
+        if shapes is not None:
+            shapes[(collection, event.command_name, query_shape)] += 1
+        if QUERY_PLAN_CHECK and event.command_name in EXPLAINABLE and command_filter(event.command_name, event.command):
+            plan_checker.submit(event, collection, query_shape, route)
+
+    def _finished(self, event):
+        started = self._started.pop((event.connection_id, event.request_id), None)
+        if started and event.duration_micros >= SLOW_QUERY_MS * 1000:
+            collection, query_shape, route = started
+            print(f"⚠ Slow query: {event.duration_micros / 1000:.1f}ms {event.command_name} {collection} "
+                  f"{query_shape} (route {route})")
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+query_listener = QueryListener()
+
+# HTTP middleware
+
+def repeated_shapes(shapes: Counter) -> list:
+    """(count, collection, command, shape) for shapes issued at least N_PLUS_ONE_THRESHOLD times"""
+    return sorted(((count, *key) for key, count in shapes.items() if count >= N_PLUS_ONE_THRESHOLD), reverse=True)
+
+class QueryLogMiddleware:
+    """ASGI middleware attributing MongoDB commands to routes and flagging N+1 query patterns"""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        shapes = Counter()
+        shapes_token = _request_shapes.set(shapes)
+        scope_token = _request_scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_shapes.reset(shapes_token)
+            _request_scope.reset(scope_token)
+            for count, collection, command, query_shape in repeated_shapes(shapes):
+                print(f"⚠ Repeated query: {command} {collection} {query_shape} issued {count}x "
+                      f"by {scope['method']} {route_label(scope)}")
@@ -0,0 +1,251 @@
+"""Server-side HTML rendering of published pages.
+
+Each element type has a render function registered once at import time, so
+rendering a page is a single walk over its element tree with no per-request
+dispatch setup. Rendered pages are cached per (page id, updated_at), so a page
+is only rendered again after it has been edited.
+"""
+from functools import lru_cache
+import hashlib
+import html
+import os
+import re
+from cache import TTLCache
+
+PAGE_RENDER_CACHE_SIZE = int(os.getenv("PAGE_RENDER_CACHE_SIZE", 5000))
+PAGE_RENDER_CACHE_TTL = float(os.getenv("PAGE_RENDER_CACHE_TTL", 3600))
+
+RENDERERS = {}
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{title}</title>
+<meta name="description" content="{description}">
+{stylesheet}
+</head>
+<body>
+<main class="ff-page" style="{style}">
+{body}
+</main>
+</body>
+</html>
+"""
+
+BASE_CSS = (
+    "*{box-sizing:border-box}body{margin:0;font-family:system-ui,-apple-system,sans-serif}"
+    ".ff-row{display:flex;flex-wrap:wrap}.ff-col{padding:8px}"
+    ".ff-field{margin-bottom:12px}.ff-field label{display:block;font-size:14px;font-weight:600;"
+    "margin-bottom:6px;color:#374151}.ff-field input,.ff-field textarea,.ff-field select{width:100%;"
+    "padding:12px;border:1px solid #d1d5db;border-radius:6px;font-size:14px}"
+)
+
+SAFE_URL = re.compile(r"^(https?:|mailto:|tel:|/|#)", re.IGNORECASE)
+
+# Style keys and values come from page documents; anything that could end the
+# declaration or load a resource is dropped
+CSS_PROPERTY = re.compile(r"^[a-zA-Z-]+$")
+UNSAFE_CSS_VALUE = re.compile(r"[;{}\\]|url\s*\(|expression\s*\(", re.IGNORECASE)
+
+def renderer(*types):
+    """Register a render function for one or more element types"""
+    def register(func):
+        for element_type in types:
+            RENDERERS[element_type] = func
+        return func
+    return register
+
+@lru_cache(maxsize=512)
+def _css_name(name: str) -> str:
+    return re.sub(r"([A-Z])", lambda m: "-" + m.group(1).lower(), name)
+
+def css_value(value):
+    """The escaped value, or None if it is not a plain CSS value"""
+    if value is None or isinstance(value, (dict, list)):
+        return None
+    value = str(value)
+    return None if UNSAFE_CSS_VALUE.search(value) else html.escape(value)
+
+def css(styles) -> str:
+    if not isinstance(styles, dict):
+        return ""
+    declarations = []
+    for name, value in styles.items():
+        if not isinstance(name, str) or not CSS_PROPERTY.match(name):
+            continue
+        value = css_value(value)
+        if value is not None:
+            declarations.append(f"{_css_name(name)}:{value}")
+    return ";".join(declarations)
+
+def escape(value) -> str:
+    return html.escape("" if value is None else str(value))
+
+def safe_url(value) -> str:
+    url = "" if value is None else str(value).strip()
+    return html.escape(url) if SAFE_URL.match(url) else "#"
+
+def _content(element) -> dict:
+    # Older templates store plain text content instead of a dict
+    content = element.get("content")
+    if isinstance(content, dict):
+        return content
+    return {"text": content} if content is not None else {}
+
+def _label(content) -> str:
+    label = content.get("label")
+    return f"<label>{escape(label)}</label>" if label else ""
+
+@renderer("heading")
+def render_heading(element):
+    return '<h1 style="{}">{}</h1>'.format(css(element.get("styles")), escape(_content(element).get("text")))
+
+@renderer("text")
+def render_text(element):
+    return '<p style="{}">{}</p>'.format(css(element.get("styles")), escape(_content(element).get("text")))
+
+@renderer("button")
+def render_button(element):
+    content = _content(element)
+    return '<a href="{}" style="{}">{}</a>'.format(
+        safe_url(content.get("url") or "#"), css(element.get("styles")), escape(content.get("text"))
+    )
+
+@renderer("image")
+def render_image(element):
+    content = _content(element)
+    return '<img src="{}" alt="{}" style="{}" loading="lazy">'.format(
+        safe_url(content.get("src")), escape(content.get("alt")), css(element.get("styles"))
+    )
+
+@renderer("video")
+def render_video(element):
+    return '<iframe src="{}" style="{}" allowfullscreen loading="lazy"></iframe>'.format(
+        safe_url(_content(element).get("url")), css(element.get("styles"))
+    )
+
+@renderer("input", "email", "phone", "url", "number", "date", "time", "file")
+def render_input(element):
+    content = _content(element)
+    input_type = {"input": content.get("type") or "text", "phone": "tel"}.get(element["type"], element["type"])
+    return '<div class="ff-field">{}<input type="{}" name="{}" placeholder="{}" style="{}"{}></div>'.format(
+        _label(content), escape(input_type), escape(content.get("name") or element.get("id")),
+        escape(content.get("placeholder")), css(element.get("styles")),
+        " required" if content.get("required") else ""
+    )
+
+@renderer("textarea")
+def render_textarea(element):
+    content = _content(element)
+    return '<div class="ff-field">{}<textarea name="{}" placeholder="{}" style="{}"{}></textarea></div>'.format(
+        _label(content), escape(content.get("name") or element.get("id")), escape(content.get("placeholder")),
+        css(element.get("styles")), " required" if content.get("required") else ""
+    )
+
+@renderer("select", "multiselect")
+def render_select(element):
+    content = _content(element)
+    options = "".join(f'<option value="{escape(o)}">{escape(o)}</option>' for o in content.get("options") or [])
+    return '<div class="ff-field">{}<select name="{}" style="{}"{}>{}</select></div>'.format(
+        _label(content), escape(element.get("id")), css(element.get("styles")),
+        " multiple" if element["type"] == "multiselect" else "", options
+    )
+
+@renderer("checkbox", "toggle")
+def render_checkbox(element):
+    content = _content(element)
+    return '<label style="{}"><input type="checkbox" name="{}"{}> {}</label>'.format(
+        css(element.get("styles")), escape(element.get("id")),
+        " checked" if content.get("checked") else "", escape(content.get("label"))
+    )
+
+@renderer("radio")
+def render_radio(element):
+    content = _content(element)
+    options = "".join(
+        f'<label><input type="radio" name="{escape(element.get("id"))}" value="{escape(o)}"> {escape(o)}</label>'
+        for o in content.get("options") or []
+    )
+    return '<div style="{}"><div>{}</div>{}</div>'.format(css(element.get("styles")), escape(content.get("label")), options)
+
+@renderer("form")
+def render_form(element):
+    fields = "".join(
+        '<div class="ff-field"><input type="{}" name="{}" placeholder="{}"{}></div>'.format(
+            escape(field.get("type") or "text"), escape(field.get("name")), escape(field.get("placeholder")),
+            " required" if field.get("required") else ""
+        )
+        for field in element.get("fields") or []
+    )
+    return '<form style="{}">{}<button type="submit">{}</button></form>'.format(
+        css(element.get("styles")), fields, escape(element.get("submitText") or "Submit")
+    )
+
+@renderer("divider")
+def render_divider(element):
+    return '<hr style="{}">'.format(css(element.get("styles")))
+
+@renderer("spacer")
+def render_spacer(element):
+    return '<div style="height:{}"></div>'.format(css_value(_content(element).get("height")) or "40px")
+
+@renderer("container")
+def render_container(element):
+    return '<div style="{}">{}</div>'.format(css(element.get("styles")), render_elements(element.get("children")))
+
+def render_element(element) -> str:
+    func = RENDERERS.get(element.get("type")) if isinstance(element, dict) else None
+    # Element types without a public representation are skipped
+    return func(element) if func else ""
+
+def render_elements(elements) -> str:
+    return "\n".join(render_element(element) for element in elements or [])
+
+def render_sections(sections) -> str:
+    parts = []
+    for section in sections:
+        parts.append('<section style="{}">'.format(css(section.get("styles"))))
+        for row in section.get("rows") or []:
+            parts.append('<div class="ff-row" style="{}">'.format(css(row.get("styles"))))
+            for column in row.get("columns") or []:
+                width = column.get("width") or 12
+                parts.append('<div class="ff-col" style="flex:0 0 {:.4f}%">'.format(100 * width / 12))
+                parts.append(render_elements(column.get("elements")))
+                parts.append("</div>")
+            parts.append("</div>")
+        parts.append("</section>")
+    return "\n".join(parts)
+
+def render_page(page: dict, stylesheet_href: str = None) -> str:
+    """Render a full HTML document; the base CSS is inlined unless stylesheet_href is given"""
+    seo = page.get("seo_settings") or {}
+    if stylesheet_href:
+        stylesheet = f'<link rel="stylesheet" href="{escape(stylesheet_href)}">'
+    else:
+        stylesheet = f"<style>{BASE_CSS}</style>"
+    body = render_sections(page["sections"]) if page.get("sections") else render_elements(page.get("elements"))
+    return PAGE_TEMPLATE.format(
+        title=escape(seo.get("title") or page.get("name")),
+        description=escape(seo.get("description")),
+        stylesheet=stylesheet,
+        style=css(page.get("styles")),
+        body=body
+    )
+
+class RenderedPage:
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = '"' + hashlib.sha256(body).hexdigest() + '"'
+
+# Rendered pages keyed by (page id, updated_at)
+page_cache = TTLCache(PAGE_RENDER_CACHE_SIZE, PAGE_RENDER_CACHE_TTL)
+
+def get_cached_page(page_id: str, updated_at):
+    return page_cache.get((page_id, updated_at))
+
+def render_and_cache(page: dict) -> RenderedPage:
+    rendered = RenderedPage(render_page(page).encode())
+    page_cache.set((page["id"], page.get("updated_at")), rendered)
+    return rendered
@@ -0,0 +1,448 @@
+"""Async data access for FlowFunnels collections.
+
+All MongoDB access from the API goes through this module so route handlers
+await database calls instead of blocking the event loop.
+"""
+from datetime import datetime, timedelta
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# These read their settings from the environment at import time
+from cache import user_cache
+import metrics
+import querylog
+
+# MongoDB setup
+MONGO_URL = os.getenv("MONGO_URL")
+
+_connection = {}
+
+def connect(mongo_url: str = None, database: str = "flowfunnels", mongo_client=None):
+    """(Re)create the Mongo client and point every collection handle at it"""
+    global client, db, users_collection, funnels_collection, pages_collection, analytics_collection
+    global templates_collection, rollups_collection, archive_collection, uniques_collection
+    client = mongo_client or AsyncIOMotorClient(
+        mongo_url or MONGO_URL, event_listeners=[metrics.command_listener, querylog.query_listener])
+    db = client[database]
+    _connection.update(mongo_url=mongo_url, database=database)
+
+    # Collections
+    users_collection = db.users
+    funnels_collection = db.funnels
+    pages_collection = db.pages
+    analytics_collection = db.analytics
+    templates_collection = db.templates
+    rollups_collection = db.analytics_rollups
+    archive_collection = db.analytics_archive
+    uniques_collection = db.analytics_uniques
+
+connect()
+
+# A client must not be shared across fork (its pools and monitor threads are
+# not copied), so forked workers such as gunicorn's start with a fresh one
+os.register_at_fork(after_in_child=lambda: connect(**_connection))
+
+# Documents are returned without MongoDB's _id field
+NO_ID = {"_id": 0}
+
+# Fields returned by the dashboard's summary listing
+FUNNEL_SUMMARY = {"_id": 0, "id": 1, "name": 1, "description": 1, "pages": 1,
+                  "published": 1, "created_at": 1, "updated_at": 1}
+
+# Users
+async def get_user_by_id(user_id: str):
+    return await users_collection.find_one({"id": user_id}, NO_ID)
+
+async def get_user_by_email(email: str):
+    return await users_collection.find_one({"email": email}, NO_ID)
+
+async def create_user(user: dict):
+    await users_collection.insert_one(dict(user))
+
+async def update_user(user_id: str, fields: dict):
+    await users_collection.update_one({"id": user_id}, {"$set": fields})
+    user_cache.invalidate(user_id)
+
+# Funnels
+async def list_funnels(user_id: str, limit, sort: str = "updated_at", descending: bool = True,
+                       after: tuple = None, summary: bool = False):
+    """Return one keyset page of a user's funnels ordered by (sort, id), or all of them if limit is None.
+
+    after is the (sort value, id) of the last funnel on the previous page.
+    """
+    query = {"user_id": user_id}
+    if after is not None:
+        op = "$lt" if descending else "$gt"
+        value, last_id = after
+        query["$or"] = [{sort: {op: value}}, {sort: value, "id": {op: last_id}}]
+    direction = -1 if descending else 1
+    cursor = funnels_collection.find(query, FUNNEL_SUMMARY if summary else NO_ID)
+    cursor = cursor.sort([(sort, direction), ("id", direction)])
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    return await cursor.to_list(length=limit)
+
+async def get_funnel(funnel_id: str, user_id: str):
+    return await funnels_collection.find_one({"id": funnel_id, "user_id": user_id}, NO_ID)
+
+async def create_funnel(funnel: dict):
+    await funnels_collection.insert_one(dict(funnel))
+
+async def create_funnel_with_pages(funnel: dict, pages: list, use_transaction: bool = False):
+    """Insert pages in one batch, then the funnel that references them.
+
+    The funnel is written last so it never appears half-cloned. With
+    use_transaction both writes commit together (requires a replica set).
+    """
+    if use_transaction:
+        async with await client.start_session() as session:
+            async with session.start_transaction():
+                if pages:
+                    await pages_collection.insert_many([dict(page) for page in pages], session=session)
+                await funnels_collection.insert_one(dict(funnel), session=session)
+        return
+    if pages:
+        await pages_collection.insert_many([dict(page) for page in pages], ordered=False)
+    await funnels_collection.insert_one(dict(funnel))
+
+async def update_funnel(funnel_id: str, fields: dict):
+    await funnels_collection.update_one({"id": funnel_id}, {"$set": fields})
+
+async def is_funnel_published(funnel_id: str) -> bool:
+    return await funnels_collection.find_one({"id": funnel_id, "published": True}, {"_id": 1}) is not None
+
+async def delete_funnel(funnel_id: str, user_id: str) -> bool:
+    result = await funnels_collection.delete_one({"id": funnel_id, "user_id": user_id})
+    return result.deleted_count > 0
+
+async def add_funnel_page(funnel_id: str, page_id: str, updated_at):
+    await funnels_collection.update_one(
+        {"id": funnel_id},
+        {"$push": {"pages": page_id}, "$set": {"updated_at": updated_at}}
+    )
+
+async def remove_funnel_page(funnel_id: str, page_id: str, updated_at):
+    await funnels_collection.update_one(
+        {"id": funnel_id},
+        {"$pull": {"pages": page_id}, "$set": {"updated_at": updated_at}}
+    )
+
+# Pages
+# Pages carry their owner's user_id so access checks need no funnel lookup
+async def get_page(page_id: str, user_id: str):
+    return await pages_collection.find_one({"id": page_id, "user_id": user_id}, NO_ID)
+
+async def get_page_version(funnel_id: str, slug: str):
+    return await pages_collection.find_one(
+        {"funnel_id": funnel_id, "slug": slug},
+        {"_id": 0, "id": 1, "updated_at": 1}
+    )
+
+async def get_public_page(page_id: str):
+    return await pages_collection.find_one({"id": page_id}, NO_ID)
+
+async def list_funnel_pages(funnel_id: str):
+    return await pages_collection.find({"funnel_id": funnel_id}, NO_ID).to_list(length=None)
+
+async def list_funnel_page_names(funnel_id: str):
+    projection = {"_id": 0, "id": 1, "name": 1, "slug": 1}
+    return await pages_collection.find({"funnel_id": funnel_id}, projection).to_list(length=None)
+
+async def create_page(page: dict):
+    await pages_collection.insert_one(dict(page))
+
+async def update_page(page_id: str, user_id: str, fields: dict):
+    """Update an owned page; returns its funnel_id, or None if not found/owned"""
+    page = await pages_collection.find_one_and_update(
+        {"id": page_id, "user_id": user_id},
+        {"$set": fields},
+        projection={"_id": 0, "funnel_id": 1}
+    )
+    return page["funnel_id"] if page else None
+
+async def get_page_funnel_id(page_id: str, user_id: str):
+    """funnel_id of an owned page, or None if not found/owned"""
+    page = await pages_collection.find_one({"id": page_id, "user_id": user_id}, {"_id": 0, "funnel_id": 1})
+    return page["funnel_id"] if page else None
+
+async def touch_page(page_id: str, user_id: str, updated_at):
+    """Set updated_at on an owned page; returns its funnel_id, or None if not found/owned"""
+    return await update_page(page_id, user_id, {"updated_at": updated_at})
+
+async def get_page_tree(page_id: str, user_id: str):
+    return await pages_collection.find_one(
+        {"id": page_id, "user_id": user_id},
+        {"_id": 0, "elements": 1, "sections": 1}
+    )
+
+async def bulk_update_page(requests: list) -> int:
+    """Apply the updates in order; returns how many of them matched the page"""
+    result = await pages_collection.bulk_write(requests, ordered=True)
+    return result.matched_count
+
+async def delete_page(page_id: str, user_id: str):
+    """Delete an owned page; returns its funnel_id, or None if not found/owned"""
+    page = await pages_collection.find_one_and_delete(
+        {"id": page_id, "user_id": user_id},
+        projection={"_id": 0, "funnel_id": 1}
+    )
+    return page["funnel_id"] if page else None
+
+async def delete_funnel_pages(funnel_id: str):
+    await pages_collection.delete_many({"funnel_id": funnel_id})
+
+# Analytics
+# Server error code for a duplicate key
+DUPLICATE_KEY = 11000
+
+async def insert_events(events: list) -> set:
+    """Insert events (pymongo sets each one's _id); returns the indexes of those that could not be stored.
+
+    An event rejected as a duplicate key was stored by an earlier attempt, so it does not count as failed.
+    """
+    try:
+        await analytics_collection.insert_many(events, ordered=False)
+    except BulkWriteError as exc:
+        if exc.details.get("writeConcernErrors"):
+            raise
+        return {error["index"] for error in exc.details.get("writeErrors", []) if error.get("code") != DUPLICATE_KEY}
+    return set()
+
+async def count_funnel_events(funnel_id: str, event_types: list):
+    """Count events per type on the database side using the analytics index"""
+    pipeline = [
+        {"$match": {"funnel_id": funnel_id, "event_type": {"$in": event_types}}},
+        {"$group": {"_id": "$event_type", "count": {"$sum": 1}}},
+    ]
+    counts = {event_type: 0 for event_type in event_types}
+    async for row in analytics_collection.aggregate(pipeline):
+        counts[row["_id"]] = row["count"]
+    return counts
+
+def aggregate_hourly_event_counts(funnel_id: str = None, before=None):
+    """Stream raw event counts grouped by funnel, page, event type and hour, for events before `before`"""
+    match = {"funnel_id": funnel_id} if funnel_id else {}
+    if before is not None:
+        match["timestamp"] = {"$lt": before}
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": {
+                "funnel_id": "$funnel_id",
+                "page_id": "$page_id",
+                "event_type": "$event_type",
+                "hour": {"$dateToString": {"format": "%Y-%m-%dT%H", "date": "$timestamp"}},
+            },
+            "count": {"$sum": 1},
+        }},
+        {"$project": {
+            "_id": 0,
+            "funnel_id": "$_id.funnel_id",
+            "page_id": "$_id.page_id",
+            "event_type": "$_id.event_type",
+            "hour": "$_id.hour",
+            "count": 1,
+        }},
+    ]
+    return analytics_collection.aggregate(pipeline, allowDiskUse=True)
+
+def _event_query(funnel_id: str, start=None, end=None, after=None) -> dict:
+    """Match a funnel's events in [start, end], newer than after when given"""
+    query = {"funnel_id": funnel_id}
+    bounds = {}
+    if start:
+        bounds["$gte"] = start
+    if after and (not start or after >= start):
+        bounds.pop("$gte", None)
+        bounds["$gt"] = after
+    if end:
+        bounds["$lte"] = end
+    if bounds:
+        query["timestamp"] = bounds
+    return query
+
+def stream_events(funnel_id: str, start=None, end=None, after=None, batch_size: int = 5000):
+    """A funnel's raw events in time order, read through a server-side cursor"""
+    return (analytics_collection.find(_event_query(funnel_id, start, end, after), NO_ID)
+            .sort("timestamp", 1)
+            .batch_size(batch_size))
+
+def stream_session_events(funnel_id: str, start=None, end=None, after=None, batch_size: int = 5000):
+    """Events that carry a session id, ordered by session and then time"""
+    query = _event_query(funnel_id, start, end, after)
+    query["metadata.session_id"] = {"$exists": True}
+    projection = {"_id": 0, "metadata.session_id": 1, "page_id": 1, "event_type": 1, "timestamp": 1}
+    return (analytics_collection.find(query, projection)
+            .sort([("metadata.session_id", 1), ("timestamp", 1)])
+            .batch_size(batch_size))
+
+async def list_event_funnel_ids(before):
+    """Funnels that have raw events at or before a timestamp"""
+    return await analytics_collection.distinct("funnel_id", {"timestamp": {"$lte": before}})
+
+async def delete_events(funnel_id: str, before):
+    result = await analytics_collection.delete_many({"funnel_id": funnel_id, "timestamp": {"$lte": before}})
+    return result.deleted_count
+
+# Unique visitor sketches
+async def max_unique_registers(updates: dict):
+    """Raise HyperLogLog registers keyed by (funnel_id, page_id, day) to at least the given ranks"""
+    requests = [
+        UpdateOne(
+            {"funnel_id": funnel_id, "page_id": page_id, "day": day},
+            {"$max": {f"registers.{index}": rank for index, rank in registers.items()}},
+            upsert=True
+        )
+        for (funnel_id, page_id, day), registers in updates.items()
+    ]
+    for start in range(0, len(requests), 1000):
+        await uniques_collection.bulk_write(requests[start:start + 1000], ordered=False)
+
+async def find_unique_sketches(funnel_id: str, page_id, start, end):
+    """Daily sketches of a funnel (page_id None) or one of its pages, oldest first"""
+    query = {"funnel_id": funnel_id, "page_id": page_id, "day": {"$gte": start, "$lte": end}}
+    projection = {"_id": 0, "day": 1, "registers": 1}
+    return await uniques_collection.find(query, projection).sort("day", 1).to_list(length=None)
+
+# Archived events
+# Events at or before a funnel's archived_until live in Parquet files, not in MongoDB
+async def get_archive_watermark(funnel_id: str):
+    doc = await archive_collection.find_one({"funnel_id": funnel_id}, {"_id": 0, "archived_until": 1})
+    return doc["archived_until"] if doc else None
+
+async def get_archive_watermarks() -> dict:
+    return {doc["funnel_id"]: doc["archived_until"]
+            async for doc in archive_collection.find({}, {"_id": 0, "funnel_id": 1, "archived_until": 1})}
+
+async def set_archive_watermark(funnel_id: str, archived_until):
+    await archive_collection.update_one(
+        {"funnel_id": funnel_id},
+        {"$set": {"archived_until": archived_until}},
+        upsert=True
+    )
+
+# Analytics rollups
+async def increment_rollups(counts: dict):
+    """Add counts keyed by (funnel_id, page_id, event_type, granularity, bucket)"""
+    requests = [
+        UpdateOne(
+            {"funnel_id": funnel_id, "granularity": granularity, "bucket": bucket,
+             "page_id": page_id, "event_type": event_type},
+            {"$inc": {"count": count}},
+            upsert=True
+        )
+        for (funnel_id, page_id, event_type, granularity, bucket), count in counts.items()
+    ]
+    for start in range(0, len(requests), 1000):
+        await rollups_collection.bulk_write(requests[start:start + 1000], ordered=False)
+
+async def set_backfilled_rollups(counts: dict, run: str):
+    """Set the backfilled counts keyed like increment_rollups; `run` marks the buckets this backfill wrote"""
+    requests = [
+        UpdateOne(
+            {"funnel_id": funnel_id, "granularity": granularity, "bucket": bucket,
+             "page_id": page_id, "event_type": event_type},
+            {"$set": {"backfill": count, "backfill_run": run}},
+            upsert=True
+        )
+        for (funnel_id, page_id, event_type, granularity, bucket), count in counts.items()
+    ]
+    for start in range(0, len(requests), 1000):
+        await rollups_collection.bulk_write(requests[start:start + 1000], ordered=False)
+
+async def clear_backfilled_rollups(run: str, funnel_id: str = None):
+    """Remove backfilled counts that an earlier backfill wrote and this run did not"""
+    query = {"backfill_run": {"$exists": True, "$ne": run}}
+    if funnel_id:
+        query["funnel_id"] = funnel_id
+    await rollups_collection.update_many(query, {"$unset": {"backfill": "", "backfill_run": ""}})
+
+# Live counts and backfilled counts of a rollup bucket
+ROLLUP_COUNT = {"$add": [{"$ifNull": ["$count", 0]}, {"$ifNull": ["$backfill", 0]}]}
+
+async def sum_rollups(funnel_id: str, event_types: list, granularity: str = "day"):
+    """Total rolled-up counts per event type for a funnel"""
+    pipeline = [
+        {"$match": {"funnel_id": funnel_id, "granularity": granularity, "event_type": {"$in": event_types}}},
+        {"$group": {"_id": "$event_type", "count": {"$sum": ROLLUP_COUNT}}},
+    ]
+    counts = {event_type: 0 for event_type in event_types}
+    async for row in rollups_collection.aggregate(pipeline):
+        counts[row["_id"]] = row["count"]
+    return counts
+
+async def find_rollups(funnel_id: str, granularity: str, start, end, page_id: str = None):
+    """Rollup buckets of a funnel with start <= bucket <= end"""
+    query = {"funnel_id": funnel_id, "granularity": granularity, "bucket": {"$gte": start, "$lte": end}}
+    if page_id is not None:
+        query["page_id"] = page_id
+    projection = {"_id": 0, "bucket": 1, "event_type": 1, "count": 1, "backfill": 1}
+    rows = await rollups_collection.find(query, projection).to_list(length=None)
+    for row in rows:
+        row["count"] = row.get("count", 0) + row.pop("backfill", 0)
+    return rows
+
+# Rollups state: when live counting starts and whether the events before it have been counted
+async def get_rollups_state():
+    return await db.analytics_state.find_one({"_id": "rollups"}, {"_id": 0})
+
+async def start_rollups(cutoff):
+    """Record the rollups cutoff unless one is set already; returns the cutoff in effect"""
+    await db.analytics_state.update_one({"_id": "rollups"}, {"$setOnInsert": {"cutoff": cutoff}}, upsert=True)
+    return (await get_rollups_state())["cutoff"]
+
+async def mark_rollups_backfilled(backfilled_at):
+    await db.analytics_state.update_one({"_id": "rollups"}, {"$set": {"backfilled_at": backfilled_at}})
+
+# Collection versions, bumped whenever a cached collection changes
+async def get_collection_version(name: str) -> int:
+    doc = await db.collection_versions.find_one({"_id": name})
+    return doc["version"] if doc else 0
+
+async def bump_collection_version(name: str):
+    await db.collection_versions.update_one({"_id": name}, {"$inc": {"version": 1}}, upsert=True)
+
+# Startup locks, held by the one process running startup tasks
+async def acquire_lock(name: str, owner: str, ttl: float) -> bool:
+    """Take the lock if it is free or its holder's lease has expired"""
+    now = datetime.utcnow()
+    try:
+        await db.startup_locks.update_one(
+            {"_id": name, "expires_at": {"$lt": now}},
+            {"$set": {"owner": owner, "acquired_at": now, "expires_at": now + timedelta(seconds=ttl)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Held by someone else: the filter did not match and the upsert hit the existing _id
+        return False
+    return True
+
+async def get_lock(name: str):
+    return await db.startup_locks.find_one({"_id": name})
+
+async def renew_lock(name: str, owner: str, ttl: float) -> bool:
+    """Extend the holder's lease; False if it no longer holds the lock"""
+    result = await db.startup_locks.update_one(
+        {"_id": name, "owner": owner},
+        {"$set": {"expires_at": datetime.utcnow() + timedelta(seconds=ttl)}}
+    )
+    return result.matched_count == 1
+
+async def release_lock(name: str, owner: str):
+    await db.startup_locks.delete_one({"_id": name, "owner": owner})
+
+async def expire_lock(name: str, owner: str):
+    """Give the lock up without releasing it, so a waiting process takes over"""
+    await db.startup_locks.update_one({"_id": name, "owner": owner}, {"$set": {"expires_at": datetime.min}})
+
+# Templates
+async def list_templates():
+    return await templates_collection.find({}, NO_ID).to_list(length=None)
+
+async def get_template(template_id: str):
+    return await templates_collection.find_one({"id": template_id}, NO_ID)
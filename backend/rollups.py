@@ -0,0 +1,119 @@
+"""Time-bucketed analytics rollups.
+
+Raw events are counted per (funnel_id, page_id, event_type, bucket) at hour
+and day granularity in the analytics_rollups collection. Counts are kept up
+to date with upsert $inc as the ingestion buffer flushes, so dashboards read
+a handful of small rollup documents instead of scanning raw events.
+
+Live counting starts at a cutoff that migration 0003 records
+ROLLUPS_CUTOFF_DELAY seconds after the upgrade, so events still tracked by
+workers of the previous version fall before it. Events before the cutoff are
+counted once by backfill, which the server runs in the background after the
+delay has passed again; it $sets a separate `backfill` count per bucket, so
+it never counts an event that live tracking counted and can be re-run at any
+time. Until it has finished, dashboards count raw events instead.
+
+Run `python rollups.py [--funnel-id ID]` to rebuild the backfilled counts
+from raw events, including archived ones.
+"""
+import argparse
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta
+import os
+import uuid
+import repository as repo
+
+ROLLUPS_CUTOFF_DELAY = float(os.getenv("ROLLUPS_CUTOFF_DELAY", 60))
+
+GRANULARITIES = ("hour", "day")
+
+# Cached once known; the cutoff never changes after it is recorded
+_cutoff = None
+_backfilled = False
+
+def bucket_start(timestamp: datetime, granularity: str) -> datetime:
+    if granularity == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def count_events(events) -> Counter:
+    """Count events per rollup key: (funnel_id, page_id, event_type, granularity, bucket)"""
+    counts = Counter()
+    for event in events:
+        for granularity in GRANULARITIES:
+            key = (event["funnel_id"], event.get("page_id"), event["event_type"],
+                   granularity, bucket_start(event["timestamp"], granularity))
+            counts[key] += 1
+    return counts
+
+async def live_cutoff():
+    """Timestamp from which events are counted as they are stored; None before migration 0003"""
+    global _cutoff
+    if _cutoff is None:
+        state = await repo.get_rollups_state()
+        _cutoff = state["cutoff"] if state else None
+    return _cutoff
+
+async def record_events(events: list):
+    """Fold a batch of newly stored events at or after the cutoff into the rollups"""
+    cutoff = await live_cutoff()
+    counts = count_events(event for event in events if cutoff is None or event["timestamp"] >= cutoff)
+    if counts:
+        await repo.increment_rollups(counts)
+
+async def backfilled() -> bool:
+    """True once the events before the cutoff have been counted"""
+    global _backfilled
+    if not _backfilled:
+        state = await repo.get_rollups_state()
+        _backfilled = bool(state and state.get("backfilled_at"))
+    return _backfilled
+
+async def start_live_counting():
+    """Record the cutoff from which live tracking counts events (migration 0003)"""
+    return await repo.start_rollups(datetime.utcnow() + timedelta(seconds=ROLLUPS_CUTOFF_DELAY))
+
+def _add_hour(counts: Counter, funnel_id, page_id, event_type, hour: datetime, count: int):
+    for granularity in GRANULARITIES:
+        counts[(funnel_id, page_id, event_type, granularity, bucket_start(hour, granularity))] += count
+
+async def backfill(funnel_id: str = None) -> int:
+    """Count raw and archived events before the cutoff, for one funnel or for all funnels"""
+    # Imported here so the server does not load pyarrow at startup
+    import archive
+
+    cutoff = await start_live_counting()
+    counts = Counter()
+    async for row in repo.aggregate_hourly_event_counts(funnel_id, before=cutoff):
+        hour = datetime.strptime(row["hour"], "%Y-%m-%dT%H")
+        _add_hour(counts, row["funnel_id"], row.get("page_id"), row["event_type"], hour, row["count"])
+    for (funnel, page_id, event_type, hour), count in (await archive.hourly_counts(funnel_id, cutoff)).items():
+        _add_hour(counts, funnel, page_id, event_type, hour, count)
+    run = uuid.uuid4().hex
+    if counts:
+        await repo.set_backfilled_rollups(counts, run)
+    await repo.clear_backfilled_rollups(run, funnel_id)
+    return len(counts)
+
+async def backfill_pending():
+    """Run the first backfill once events before the cutoff have been written (startup task)"""
+    state = await repo.get_rollups_state()
+    if state is None or state.get("backfilled_at"):
+        return
+    # Events tracked just before the cutoff may still be waiting in ingestion buffers
+    ready_at = state["cutoff"] + timedelta(seconds=ROLLUPS_CUTOFF_DELAY)
+    await asyncio.sleep(max((ready_at - datetime.utcnow()).total_seconds(), 0))
+    written = await backfill()
+    await repo.mark_rollups_backfilled(datetime.utcnow())
+    print(f"✓ Backfilled {written} rollup buckets")
+
+async def main(funnel_id=None):
+    written = await backfill(funnel_id)
+    print(f"✓ Rebuilt {written} backfilled rollup buckets")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild analytics rollups from raw events")
+    parser.add_argument("--funnel-id", help="only rebuild rollups for this funnel")
+    args = parser.parse_args()
+    asyncio.run(main(args.funnel_id))
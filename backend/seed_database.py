@@ -300,6 +300,9 @@ for template in templates:
     else:
         print(f"- Template already exists: {template['name']}")
 
+# Let running API servers know the template catalog changed
+db.collection_versions.update_one({"_id": "templates"}, {"$inc": {"version": 1}}, upsert=True)
+
 print(f"\nTotal templates in database: {db.templates.count_documents({})}")
 print("Database seeding complete!")
 
@@ -604,6 +604,9 @@ def seed_templates():
             templates_collection.insert_one(template)
             print(f"✓ Added template: {template['name']}")
         
+        # Let running API servers know the template catalog changed
+        db.collection_versions.update_one({"_id": "templates"}, {"$inc": {"version": 1}}, upsert=True)
+        
         print(f"\n✓ Successfully seeded {len(templates)} templates!")
         print(f"Total templates in database: {templates_collection.count_documents({})}")
         
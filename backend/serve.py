@@ -0,0 +1,81 @@
+"""Production server: one uvicorn worker process per core under gunicorn.
+
+    python serve.py [--workers N] [--bind 0.0.0.0:8001] [--preload]
+
+The gunicorn master forks WEB_CONCURRENCY workers (default: one per core)
+and restarts any that die. Send the master SIGHUP to reload gracefully: new
+workers are started with fresh code and the old ones finish their in-flight
+requests (up to GRACEFUL_TIMEOUT seconds) before exiting. With --preload the
+app is imported once in the master and shared copy-on-write, which boots
+workers faster but means SIGHUP no longer picks up code changes.
+
+Each worker gets its own MongoDB client after fork (see repository.connect),
+and startup tasks run in only one worker at a time (see startup.py).
+Metrics and caches are per worker.
+
+The app imports numpy, pandas and pyarrow lazily, on the first analytics
+request. With PRELOAD_ANALYTICS the master imports them once before forking,
+so workers share them copy-on-write and no request waits for the import.
+"""
+import argparse
+import importlib
+import os
+from gunicorn.app.base import BaseApplication
+
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+BIND = os.getenv("BIND", "0.0.0.0:8001")
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+# Workers silent for longer are restarted; startup tasks keep them alive while they run (see startup.py)
+WORKER_TIMEOUT = int(os.getenv("WORKER_TIMEOUT", 120))
+SERVER_PRELOAD = os.getenv("SERVER_PRELOAD", "false").lower() == "true"
+PRELOAD_ANALYTICS = os.getenv("PRELOAD_ANALYTICS", "true").lower() == "true"
+
+# Third-party only: they hold no connections or threads that a fork would break
+ANALYTICS_MODULES = ["numpy", "pandas", "pyarrow", "pyarrow.compute", "pyarrow.parquet"]
+
+def on_starting(server):
+    if PRELOAD_ANALYTICS:
+        for module in ANALYTICS_MODULES:
+            importlib.import_module(module)
+
+def post_worker_init(worker):
+    # uvicorn only reports to gunicorn once startup has finished, so report during startup tasks too
+    import startup
+    startup.keepalive = worker.notify
+
+class Server(BaseApplication):
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from server import app
+        return app
+
+def options(workers: int = WEB_CONCURRENCY, bind: str = BIND, preload: bool = SERVER_PRELOAD) -> dict:
+    return {
+        "bind": bind,
+        "workers": workers,
+        "worker_class": "uvicorn.workers.UvicornWorker",
+        "preload_app": preload,
+        "graceful_timeout": GRACEFUL_TIMEOUT,
+        "timeout": WORKER_TIMEOUT,
+        "keepalive": 5,
+        "accesslog": "-",
+        "on_starting": on_starting,
+        "post_worker_init": post_worker_init,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the FlowFunnels API with one worker per core")
+    parser.add_argument("--workers", type=int, default=WEB_CONCURRENCY, help="worker processes (default: cores)")
+    parser.add_argument("--bind", default=BIND, help="address to listen on")
+    parser.add_argument("--preload", action="store_true", default=SERVER_PRELOAD,
+                        help="import the app once in the master before forking workers")
+    args = parser.parse_args()
+    print(f"✓ Starting {args.workers} workers on {args.bind} (SIGHUP to reload gracefully)")
+    Server(options(args.workers, args.bind, args.preload)).run()
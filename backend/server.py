@@ -1,19 +1,44 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+# Imported first so boot timing covers everything below
+import metrics
+from fastapi import FastAPI, BackgroundTasks, Depends, HTTPException, Query, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from fastapi.responses import JSONResponse, HTMLResponse, FileResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, EmailStr, Field
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Literal
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
-from passlib.context import CryptContext
-from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 import os
 from dotenv import load_dotenv
 import uuid
+import base64
+import json
+import time
+import repository as repo
+import migrations
+import startup
+from ingestion import EventBuffer, store_events
+from cache import user_cache
+from catalog import template_catalog
+import passwords
+from page_patch import apply_page_patch, PatchConflict, PatchError
+import renderer
+import publisher
+import timeseries
+import dropoff
+import export
+import files
+import uniques
+from fastjson import FastJSONResponse
+import querylog
+import rollups
 
 load_dotenv()
 
-app = FastAPI(title="FlowFunnels API")
+# Responses are serialized with orjson; handlers returning documents wrap them in
+# FastJSONResponse themselves to skip jsonable_encoder
+app = FastAPI(title="FlowFunnels API", default_response_class=FastJSONResponse)
 
 # CORS configuration
 app.add_middleware(
@@ -22,63 +47,116 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
-# MongoDB setup
-MONGO_URL = os.getenv("MONGO_URL")
-client = MongoClient(MONGO_URL)
-db = client.flowfunnels
+# Request metrics, exposed at /api/metrics
+app.add_middleware(metrics.MetricsMiddleware)
 
-# Collections
-users_collection = db.users
-funnels_collection = db.funnels
-pages_collection = db.pages
-analytics_collection = db.analytics
-templates_collection = db.templates
+# Slow-query log and repeated-query (N+1) warnings
+app.add_middleware(querylog.QueryLogMiddleware)
 
 # Security
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 43200))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Clone templates inside a transaction (needs a replica set)
+CLONE_USE_TRANSACTIONS = os.getenv("CLONE_USE_TRANSACTIONS", "false").lower() == "true"
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
+# Tracked events are acknowledged immediately and written in batches
+event_buffer = EventBuffer(store_events)
+
+# Scrape token for /api/metrics; when unset the endpoint is open
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+CACHES = {"users": user_cache, "rendered_pages": renderer.page_cache}
+
+metrics.gauge("flowfunnels_ingestion_queue_depth", "Tracked events waiting to be written",
+              lambda: {(): len(event_buffer)})
+metrics.counter_callback("flowfunnels_ingestion_events_total", "Tracked events by outcome",
+                         lambda: {("flushed",): event_buffer.flushed, ("rejected",): event_buffer.rejected,
+                                  ("failed",): event_buffer.failed},
+                         labels=("outcome",))
+metrics.counter_callback("flowfunnels_cache_hits_total", "Cache hits",
+                         lambda: {(name,): cache.hits for name, cache in CACHES.items()}, labels=("cache",))
+metrics.counter_callback("flowfunnels_cache_misses_total", "Cache misses",
+                         lambda: {(name,): cache.misses for name, cache in CACHES.items()}, labels=("cache",))
+metrics.gauge("flowfunnels_cache_hit_ratio", "Cache hit ratio since start",
+              lambda: {(name,): cache.stats()["hit_ratio"] for name, cache in CACHES.items()}, labels=("cache",))
+metrics.gauge("flowfunnels_cache_entries", "Entries held in each cache",
+              lambda: {(name,): cache.stats()["size"] for name, cache in CACHES.items()}, labels=("cache",))
+metrics.gauge("flowfunnels_password_hash_pending", "Password hash operations waiting or running",
+              lambda: {(): passwords.pending()})
+
 # Startup: Ensure demo user exists
-def ensure_demo_user():
+async def ensure_demo_user():
     """Ensure the demo user exists in the database on startup"""
     demo_email = "demo@flowfunnels.com"
     demo_password = "demo123"
     demo_name = "Demo User"
     
-    existing_user = users_collection.find_one({"email": demo_email})
+    existing_user = await repo.get_user_by_email(demo_email)
     
     if not existing_user:
         demo_user = {
             "id": str(uuid.uuid4()),
             "email": demo_email,
-            "password_hash": pwd_context.hash(demo_password),
+            "password_hash": await passwords.hash_password(demo_password),
             "name": demo_name,
             "created_at": datetime.utcnow(),
             "subscription_tier": "free"
         }
-        users_collection.insert_one(demo_user)
+        try:
+            await repo.create_user(demo_user)
+        except DuplicateKeyError:
+            # Created meanwhile by another process
+            print(f"✓ Demo user exists: {demo_email}")
+            return
         print(f"✓ Demo user created: {demo_email}")
     else:
         # Verify password is correct, update if needed
-        if not pwd_context.verify(demo_password, existing_user["password_hash"]):
-            users_collection.update_one(
-                {"email": demo_email},
-                {"$set": {"password_hash": pwd_context.hash(demo_password)}}
+        valid, new_hash = await passwords.verify_password(demo_password, existing_user["password_hash"])
+        if not valid or new_hash:
+            await repo.update_user(
+                existing_user["id"],
+                {"password_hash": new_hash or await passwords.hash_password(demo_password)}
             )
             print(f"✓ Demo user password updated: {demo_email}")
         else:
             print(f"✓ Demo user exists: {demo_email}")
 
+# Create or repair the demo account after startup; set to false in production
+ENSURE_DEMO_USER = os.getenv("ENSURE_DEMO_USER", "true").lower() == "true"
+
 # Run on startup
 @app.on_event("startup")
 async def startup_event():
-    ensure_demo_user()
+    # With several workers (see serve.py) only one of them runs these
+    await startup.run_once("startup", [migrations.ensure_indexes, migrations.run_migrations])
+    event_buffer.start()
+    # Requests are served while these run
+    startup.in_background(passwords.warm_up())
+    if ENSURE_DEMO_USER:
+        startup.in_background(startup.run_once("demo_user", [ensure_demo_user]))
+    startup.in_background(startup.run_once("rollups_backfill", [rollups.backfill_pending]))
+    metrics.boot_timer.mark("startup")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await startup.cancel_background()
+    await event_buffer.stop()
+    passwords.shutdown()
+
+@app.exception_handler(passwords.HasherBusy)
+async def hasher_busy_handler(request, exc):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Too many authentication requests, please retry"},
+        headers={"Retry-After": "1"},
+    )
 
 # Pydantic Models
 class UserRegister(BaseModel):
@@ -109,6 +187,7 @@ class FunnelUpdate(BaseModel):
     name: Optional[str] = None
     description: Optional[str] = None
     settings: Optional[Dict[str, Any]] = None
+    published: Optional[bool] = None
 
 class PageCreate(BaseModel):
     funnel_id: str
@@ -122,19 +201,25 @@ class PageUpdate(BaseModel):
     styles: Optional[Dict[str, Any]] = None
     seo_settings: Optional[Dict[str, Any]] = None
 
+class PageOperation(BaseModel):
+    op: Literal["add", "update", "remove", "move"]
+    id: Optional[str] = None
+    element: Optional[Dict[str, Any]] = None
+    changes: Optional[Dict[str, Any]] = None
+    parent_id: Optional[str] = None
+    index: Optional[int] = None
+
+class PagePatch(BaseModel):
+    operations: List[PageOperation] = Field(..., min_length=1)
+
 class AnalyticsEvent(BaseModel):
-    funnel_id: str
+    # Funnel ids name archive directories (see files.py)
+    funnel_id: str = Field(..., pattern=files.FUNNEL_ID.pattern, max_length=64)
     page_id: Optional[str] = None
     event_type: str
     metadata: Optional[Dict[str, Any]] = None
 
 # Helper Functions
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-def get_password_hash(password):
-    return pwd_context.hash(password)
-
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -145,6 +230,25 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def encode_cursor(value: datetime, item_id: str) -> str:
+    raw = json.dumps([value.isoformat(), item_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def conditional_response(request: Request, body: bytes, etag: str, media_type: str, cache_control: str):
+    """Return body with an ETag, or 304 when the client already has it"""
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if_none_match = [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]
+    if etag in if_none_match or "*" in if_none_match:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type=media_type, headers=headers)
+
+def decode_cursor(cursor: str):
+    try:
+        value, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(value), item_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -159,29 +263,31 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     except JWTError:
         raise credentials_exception
     
-    user = users_collection.find_one({"id": user_id})
+    user = user_cache.get(user_id)
     if user is None:
-        raise credentials_exception
+        user = await repo.get_user_by_id(user_id)
+        if user is None:
+            raise credentials_exception
+        user_cache.set(user_id, user)
     return user
 
 # Auth Routes
 @app.post("/api/auth/register", response_model=Token)
 async def register(user_data: UserRegister):
-    # Check if user exists
-    if users_collection.find_one({"email": user_data.email}):
-        raise HTTPException(status_code=400, detail="Email already registered")
-    
-    # Create user
+    # Create user; the unique email index rejects duplicates
     user_id = str(uuid.uuid4())
     user = {
         "id": user_id,
         "email": user_data.email,
-        "password_hash": get_password_hash(user_data.password),
+        "password_hash": await passwords.hash_password(user_data.password),
         "name": user_data.name,
         "created_at": datetime.utcnow(),
         "subscription_tier": "free"
     }
-    users_collection.insert_one(user)
+    try:
+        await repo.create_user(user)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create access token
     access_token = create_access_token(data={"sub": user_id})
@@ -189,14 +295,21 @@ async def register(user_data: UserRegister):
 
 @app.post("/api/auth/login", response_model=Token)
 async def login(user_data: UserLogin):
-    user = users_collection.find_one({"email": user_data.email})
-    if not user or not verify_password(user_data.password, user["password_hash"]):
+    user = await repo.get_user_by_email(user_data.email)
+    valid, new_hash = (False, None)
+    if user:
+        valid, new_hash = await passwords.verify_password(user_data.password, user["password_hash"])
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
     
+    # Transparently upgrade hashes made with an outdated cost
+    if new_hash:
+        await repo.update_user(user["id"], {"password_hash": new_hash})
+    
     access_token = create_access_token(data={"sub": user["id"]})
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -225,61 +338,127 @@ async def create_funnel(funnel: FunnelCreate, current_user: dict = Depends(get_c
         "updated_at": datetime.utcnow(),
         "published": False
     }
-    funnels_collection.insert_one(new_funnel)
-    # Return without MongoDB's _id field
-    return {
-        "id": funnel_id,
-        "user_id": current_user["id"],
-        "name": funnel.name,
-        "description": funnel.description,
-        "pages": [],
-        "settings": {},
-        "created_at": new_funnel["created_at"],
-        "updated_at": new_funnel["updated_at"],
-        "published": False
-    }
+    await repo.create_funnel(new_funnel)
+    return new_funnel
+
+# Page size when only a cursor is given
+DEFAULT_FUNNEL_PAGE_SIZE = 50
 
 @app.get("/api/funnels")
-async def get_funnels(current_user: dict = Depends(get_current_user)):
-    funnels = list(funnels_collection.find({"user_id": current_user["id"]}))
-    for funnel in funnels:
-        funnel.pop("_id", None)
-    return funnels
+async def get_funnels(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=200),
+    cursor: Optional[str] = None,
+    sort: Literal["updated_at", "created_at"] = "updated_at",
+    order: Literal["desc", "asc"] = "desc",
+    view: Literal["full", "summary"] = "full",
+    current_user: dict = Depends(get_current_user)
+):
+    # Without limit or cursor every funnel is returned, as before pagination existed
+    if limit is None and cursor is None:
+        funnels = await repo.list_funnels(
+            current_user["id"], None, sort=sort, descending=order == "desc", summary=view == "summary")
+        return FastJSONResponse(funnels)
+    limit = limit or DEFAULT_FUNNEL_PAGE_SIZE
+
+    # Fetch one extra funnel to know whether another page exists
+    funnels = await repo.list_funnels(
+        current_user["id"],
+        limit + 1,
+        sort=sort,
+        descending=order == "desc",
+        after=decode_cursor(cursor) if cursor else None,
+        summary=view == "summary"
+    )
+    if len(funnels) > limit:
+        funnels = funnels[:limit]
+        last = funnels[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last[sort], last["id"])
+    return FastJSONResponse(funnels, headers=dict(response.headers))
 
 @app.get("/api/funnels/{funnel_id}")
 async def get_funnel(funnel_id: str, current_user: dict = Depends(get_current_user)):
-    funnel = funnels_collection.find_one({"id": funnel_id, "user_id": current_user["id"]})
+    funnel = await repo.get_funnel(funnel_id, current_user["id"])
     if not funnel:
         raise HTTPException(status_code=404, detail="Funnel not found")
-    funnel.pop("_id", None)
-    return funnel
+    return FastJSONResponse(funnel)
 
 @app.put("/api/funnels/{funnel_id}")
 async def update_funnel(funnel_id: str, funnel_update: FunnelUpdate, current_user: dict = Depends(get_current_user)):
-    funnel = funnels_collection.find_one({"id": funnel_id, "user_id": current_user["id"]})
+    funnel = await repo.get_funnel(funnel_id, current_user["id"])
     if not funnel:
         raise HTTPException(status_code=404, detail="Funnel not found")
     
     update_data = {k: v for k, v in funnel_update.dict().items() if v is not None}
     update_data["updated_at"] = datetime.utcnow()
     
-    funnels_collection.update_one({"id": funnel_id}, {"$set": update_data})
+    # Publishing renders static artifacts before the flag flips
+    if funnel_update.published is True:
+        manifest = await publisher.publish_funnel(funnel_id, await repo.list_funnel_pages(funnel_id))
+        update_data["published_version"] = manifest["version"]
+    elif funnel_update.published is False:
+        await publisher.unpublish_funnel(funnel_id)
+    
+    await repo.update_funnel(funnel_id, update_data)
     return {"message": "Funnel updated successfully"}
 
+@app.post("/api/funnels/{funnel_id}/publish")
+async def publish_funnel(funnel_id: str, current_user: dict = Depends(get_current_user)):
+    funnel = await repo.get_funnel(funnel_id, current_user["id"])
+    if not funnel:
+        raise HTTPException(status_code=404, detail="Funnel not found")
+    
+    manifest = await publisher.publish_funnel(funnel_id, await repo.list_funnel_pages(funnel_id))
+    await repo.update_funnel(funnel_id, {
+        "published": True,
+        "published_version": manifest["version"],
+        "updated_at": datetime.utcnow()
+    })
+    return manifest
+
+@app.post("/api/funnels/{funnel_id}/rollback")
+async def rollback_funnel(funnel_id: str, version: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    funnel = await repo.get_funnel(funnel_id, current_user["id"])
+    if not funnel:
+        raise HTTPException(status_code=404, detail="Funnel not found")
+    
+    try:
+        manifest = await publisher.rollback_funnel(funnel_id, version)
+    except publisher.PublishError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    await repo.update_funnel(funnel_id, {
+        "published": True,
+        "published_version": manifest["version"],
+        "updated_at": datetime.utcnow()
+    })
+    return manifest
+
+@app.get("/api/funnels/{funnel_id}/versions")
+async def get_funnel_versions(funnel_id: str, current_user: dict = Depends(get_current_user)):
+    funnel = await repo.get_funnel(funnel_id, current_user["id"])
+    if not funnel:
+        raise HTTPException(status_code=404, detail="Funnel not found")
+    
+    manifest = await publisher.current_manifest(funnel_id)
+    return {
+        "current": manifest["version"] if manifest else None,
+        "versions": await publisher.list_versions(funnel_id)
+    }
+
 @app.delete("/api/funnels/{funnel_id}")
 async def delete_funnel(funnel_id: str, current_user: dict = Depends(get_current_user)):
-    result = funnels_collection.delete_one({"id": funnel_id, "user_id": current_user["id"]})
-    if result.deleted_count == 0:
+    if not await repo.delete_funnel(funnel_id, current_user["id"]):
         raise HTTPException(status_code=404, detail="Funnel not found")
-    # Also delete associated pages
-    pages_collection.delete_many({"funnel_id": funnel_id})
+    # Also delete associated pages and take the funnel offline
+    await repo.delete_funnel_pages(funnel_id)
+    await publisher.unpublish_funnel(funnel_id)
     return {"message": "Funnel deleted successfully"}
 
 # Page Routes
 @app.post("/api/pages")
 async def create_page(page: PageCreate, current_user: dict = Depends(get_current_user)):
     # Verify funnel ownership
-    funnel = funnels_collection.find_one({"id": page.funnel_id, "user_id": current_user["id"]})
+    funnel = await repo.get_funnel(page.funnel_id, current_user["id"])
     if not funnel:
         raise HTTPException(status_code=404, detail="Funnel not found")
     
@@ -288,6 +467,7 @@ async def create_page(page: PageCreate, current_user: dict = Depends(get_current
     new_page = {
         "id": page_id,
         "funnel_id": page.funnel_id,
+        "user_id": current_user["id"],
         "name": page.name,
         "slug": slug,
         "elements": [],
@@ -297,90 +477,69 @@ async def create_page(page: PageCreate, current_user: dict = Depends(get_current
         "created_at": datetime.utcnow(),
         "updated_at": datetime.utcnow()
     }
-    pages_collection.insert_one(new_page)
+    await repo.create_page(new_page)
     
     # Add page to funnel's pages array
-    funnels_collection.update_one(
-        {"id": page.funnel_id},
-        {"$push": {"pages": page_id}, "$set": {"updated_at": datetime.utcnow()}}
-    )
+    await repo.add_funnel_page(page.funnel_id, page_id, datetime.utcnow())
     
-    # Return without MongoDB's _id field
-    return {
-        "id": page_id,
-        "funnel_id": page.funnel_id,
-        "name": page.name,
-        "slug": slug,
-        "elements": [],
-        "sections": [],
-        "styles": {},
-        "seo_settings": {},
-        "created_at": new_page["created_at"],
-        "updated_at": new_page["updated_at"]
-    }
+    return new_page
 
 @app.get("/api/pages/{page_id}")
 async def get_page(page_id: str, current_user: dict = Depends(get_current_user)):
-    page = pages_collection.find_one({"id": page_id})
+    page = await repo.get_page(page_id, current_user["id"])
     if not page:
         raise HTTPException(status_code=404, detail="Page not found")
-    
-    # Verify ownership through funnel
-    funnel = funnels_collection.find_one({"id": page["funnel_id"], "user_id": current_user["id"]})
-    if not funnel:
-        raise HTTPException(status_code=403, detail="Access denied")
-    
-    page.pop("_id", None)
-    return page
+    return FastJSONResponse(page)
 
 @app.put("/api/pages/{page_id}")
-async def update_page(page_id: str, page_update: PageUpdate, current_user: dict = Depends(get_current_user)):
-    page = pages_collection.find_one({"id": page_id})
-    if not page:
-        raise HTTPException(status_code=404, detail="Page not found")
-    
-    # Verify ownership
-    funnel = funnels_collection.find_one({"id": page["funnel_id"], "user_id": current_user["id"]})
-    if not funnel:
-        raise HTTPException(status_code=403, detail="Access denied")
-    
+async def update_page(page_id: str, page_update: PageUpdate, background_tasks: BackgroundTasks, current_user: dict = Depends(get_current_user)):
     update_data = {k: v for k, v in page_update.dict().items() if v is not None}
     update_data["updated_at"] = datetime.utcnow()
     
-    pages_collection.update_one({"id": page_id}, {"$set": update_data})
-    funnels_collection.update_one({"id": page["funnel_id"]}, {"$set": {"updated_at": datetime.utcnow()}})
+    # Ownership check and write in one query
+    funnel_id = await repo.update_page(page_id, current_user["id"], update_data)
+    if not funnel_id:
+        raise HTTPException(status_code=404, detail="Page not found")
+    
+    # Touch the funnel after the response is sent
+    background_tasks.add_task(repo.update_funnel, funnel_id, {"updated_at": update_data["updated_at"]})
     
     return {"message": "Page updated successfully"}
 
+@app.patch("/api/pages/{page_id}")
+async def patch_page(page_id: str, page_patch: PagePatch, background_tasks: BackgroundTasks, current_user: dict = Depends(get_current_user)):
+    operations = [operation.dict(exclude_none=True) for operation in page_patch.operations]
+    try:
+        funnel_id = await apply_page_patch(page_id, current_user["id"], operations)
+    except PatchConflict as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+    except PatchError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    if not funnel_id:
+        raise HTTPException(status_code=404, detail="Page not found")
+    
+    background_tasks.add_task(repo.update_funnel, funnel_id, {"updated_at": datetime.utcnow()})
+    
+    return {"message": "Page patched successfully"}
+
 @app.delete("/api/pages/{page_id}")
 async def delete_page(page_id: str, current_user: dict = Depends(get_current_user)):
-    page = pages_collection.find_one({"id": page_id})
-    if not page:
+    # Ownership check and delete in one query
+    funnel_id = await repo.delete_page(page_id, current_user["id"])
+    if not funnel_id:
         raise HTTPException(status_code=404, detail="Page not found")
     
-    # Verify ownership
-    funnel = funnels_collection.find_one({"id": page["funnel_id"], "user_id": current_user["id"]})
-    if not funnel:
-        raise HTTPException(status_code=403, detail="Access denied")
-    
-    pages_collection.delete_one({"id": page_id})
-    funnels_collection.update_one(
-        {"id": page["funnel_id"]},
-        {"$pull": {"pages": page_id}, "$set": {"updated_at": datetime.utcnow()}}
-    )
+    await repo.remove_funnel_page(funnel_id, page_id, datetime.utcnow())
     
     return {"message": "Page deleted successfully"}
 
 @app.get("/api/funnels/{funnel_id}/pages")
 async def get_funnel_pages(funnel_id: str, current_user: dict = Depends(get_current_user)):
-    funnel = funnels_collection.find_one({"id": funnel_id, "user_id": current_user["id"]})
+    funnel = await repo.get_funnel(funnel_id, current_user["id"])
     if not funnel:
         raise HTTPException(status_code=404, detail="Funnel not found")
     
-    pages = list(pages_collection.find({"funnel_id": funnel_id}))
-    for page in pages:
-        page.pop("_id", None)
-    return pages
+    return FastJSONResponse(await repo.list_funnel_pages(funnel_id))
 
 # Analytics Routes
 @app.post("/api/analytics/track")
@@ -393,23 +552,30 @@ async def track_event(event: AnalyticsEvent):
         "metadata": event.metadata or {},
         "timestamp": datetime.utcnow()
     }
-    analytics_collection.insert_one(event_data)
+    if not event_buffer.offer(event_data):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Tracking queue is full",
+            headers={"Retry-After": "1"},
+        )
     return {"message": "Event tracked successfully"}
 
 @app.get("/api/analytics/funnel/{funnel_id}")
 async def get_funnel_analytics(funnel_id: str, current_user: dict = Depends(get_current_user)):
     # Verify ownership
-    funnel = funnels_collection.find_one({"id": funnel_id, "user_id": current_user["id"]})
+    funnel = await repo.get_funnel(funnel_id, current_user["id"])
     if not funnel:
         raise HTTPException(status_code=404, detail="Funnel not found")
     
-    # Get analytics data
-    events = list(analytics_collection.find({"funnel_id": funnel_id}))
-    
-    # Calculate metrics
-    page_views = len([e for e in events if e["event_type"] == "page_view"])
-    button_clicks = len([e for e in events if e["event_type"] == "button_click"])
-    form_submissions = len([e for e in events if e["event_type"] == "form_submit"])
+    # Calculate metrics; raw events are counted until rollups cover the events tracked before them
+    event_types = ["page_view", "button_click", "form_submit"]
+    if await rollups.backfilled():
+        counts = await repo.sum_rollups(funnel_id, event_types)
+    else:
+        counts = await repo.count_funnel_events(funnel_id, event_types)
+    page_views = counts["page_view"]
+    button_clicks = counts["button_click"]
+    form_submissions = counts["form_submit"]
     
     return {
         "funnel_id": funnel_id,
@@ -419,65 +585,178 @@ async def get_funnel_analytics(funnel_id: str, current_user: dict = Depends(get_
         "conversion_rate": (form_submissions / page_views * 100) if page_views > 0 else 0
     }
 
+@app.get("/api/analytics/funnel/{funnel_id}/timeseries")
+async def get_funnel_timeseries(
+    funnel_id: str,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    granularity: Literal["hour", "day", "week"] = "day",
+    page_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    funnel = await repo.get_funnel(funnel_id, current_user["id"])
+    if not funnel:
+        raise HTTPException(status_code=404, detail="Funnel not found")
+
+    # Defaults to the last 30 days; timestamps are stored as naive UTC
+    end = timeseries.to_utc(end) if end else datetime.utcnow()
+    start = timeseries.to_utc(start) if start else end - timedelta(days=30)
+    if start > end:
+        raise HTTPException(status_code=400, detail="'from' must not be after 'to'")
+    try:
+        series = await timeseries.funnel_timeseries(funnel_id, start, end, granularity, page_id)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return FastJSONResponse(series)
+
+@app.get("/api/analytics/funnel/{funnel_id}/dropoff")
+async def get_funnel_dropoff(
+    funnel_id: str,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    current_user: dict = Depends(get_current_user)
+):
+    funnel = await repo.get_funnel(funnel_id, current_user["id"])
+    if not funnel:
+        raise HTTPException(status_code=404, detail="Funnel not found")
+    start = timeseries.to_utc(start) if start else None
+    end = timeseries.to_utc(end) if end else None
+    return FastJSONResponse(await dropoff.funnel_dropoff(funnel, start, end))
+
+@app.get("/api/analytics/funnel/{funnel_id}/uniques")
+async def get_funnel_uniques(
+    funnel_id: str,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    page_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    funnel = await repo.get_funnel(funnel_id, current_user["id"])
+    if not funnel:
+        raise HTTPException(status_code=404, detail="Funnel not found")
+    end = timeseries.to_utc(end) if end else datetime.utcnow()
+    start = timeseries.to_utc(start) if start else end - timedelta(days=30)
+    if start > end:
+        raise HTTPException(status_code=400, detail="'from' must not be after 'to'")
+    return FastJSONResponse(await uniques.count_uniques(funnel_id, start, end, page_id))
+
+@app.get("/api/analytics/funnel/{funnel_id}/export")
+async def export_funnel_events(
+    funnel_id: str,
+    format: Literal["ndjson", "csv", "parquet"] = "ndjson",
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    current_user: dict = Depends(get_current_user)
+):
+    funnel = await repo.get_funnel(funnel_id, current_user["id"])
+    if not funnel:
+        raise HTTPException(status_code=404, detail="Funnel not found")
+    start = timeseries.to_utc(start) if start else None
+    end = timeseries.to_utc(end) if end else None
+    return StreamingResponse(
+        export.export_events(funnel_id, format, start, end),
+        media_type=export.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="events-{funnel_id}.{format}"'}
+    )
+
 # Templates Routes
 @app.get("/api/templates")
-async def get_templates():
-    templates = list(templates_collection.find({}))
-    for template in templates:
-        template.pop("_id", None)
-    return templates
+async def get_templates(request: Request):
+    snapshot = await template_catalog.get()
+    return conditional_response(request, snapshot.body, snapshot.etag, "application/json", "no-cache")
 
 @app.post("/api/templates/{template_id}/clone")
-async def clone_template(template_id: str, current_user: dict = Depends(get_current_user)):
-    template = templates_collection.find_one({"id": template_id})
+async def clone_template(template_id: str, response: Response, current_user: dict = Depends(get_current_user)):
+    started = time.perf_counter()
+    template = await template_catalog.get_template(template_id)
     if not template:
         raise HTTPException(status_code=404, detail="Template not found")
     
-    # Create new funnel from template
+    # Build pages with pre-assigned ids so the funnel can be written complete
     funnel_id = str(uuid.uuid4())
+    now = datetime.utcnow()
+    new_pages = [
+        {
+            "id": str(uuid.uuid4()),
+            "funnel_id": funnel_id,
+            "user_id": current_user["id"],
+            "name": template_page["name"],
+            "slug": template_page["slug"],
+            "elements": template_page.get("elements", []),
+            "sections": template_page.get("sections", []),
+            "styles": template_page.get("styles", {}),
+            "seo_settings": template_page.get("seo_settings", {}),
+            "created_at": now,
+            "updated_at": now
+        }
+        for template_page in template.get("pages", [])
+    ]
     new_funnel = {
         "id": funnel_id,
         "user_id": current_user["id"],
         "name": f"{template['name']} (Copy)",
         "description": template.get("description", ""),
-        "pages": [],
+        "pages": [page["id"] for page in new_pages],
         "settings": template.get("settings", {}),
-        "created_at": datetime.utcnow(),
-        "updated_at": datetime.utcnow(),
+        "created_at": now,
+        "updated_at": now,
         "published": False
     }
-    funnels_collection.insert_one(new_funnel)
+    await repo.create_funnel_with_pages(new_funnel, new_pages, use_transaction=CLONE_USE_TRANSACTIONS)
     
-    # Clone pages
-    page_ids = []
-    for template_page in template.get("pages", []):
-        page_id = str(uuid.uuid4())
-        new_page = {
-            "id": page_id,
-            "funnel_id": funnel_id,
-            "name": template_page["name"],
-            "slug": template_page["slug"],
-            "elements": template_page.get("elements", []),
-            "styles": template_page.get("styles", {}),
-            "seo_settings": template_page.get("seo_settings", {}),
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow()
-        }
-        pages_collection.insert_one(new_page)
-        page_ids.append(page_id)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    response.headers["Server-Timing"] = f"clone;dur={elapsed_ms:.1f}"
+    return {"id": funnel_id, "message": "Template cloned successfully"}
+
+# Public Routes
+@app.get("/p/{funnel_id}/{slug}", response_class=HTMLResponse)
+async def view_published_page(funnel_id: str, slug: str, request: Request):
+    # Published static artifacts are served without touching the database
+    asset = await publisher.page_asset(funnel_id, slug)
+    if asset:
+        return FileResponse(asset, media_type="text/html; charset=utf-8", headers={"Cache-Control": "public, max-age=60"})
     
-    # Update funnel with page IDs
-    funnels_collection.update_one(
-        {"id": funnel_id},
-        {"$set": {"pages": page_ids}}
-    )
+    if not await repo.is_funnel_published(funnel_id):
+        raise HTTPException(status_code=404, detail="Page not found")
+    version = await repo.get_page_version(funnel_id, slug)
+    if not version:
+        raise HTTPException(status_code=404, detail="Page not found")
     
-    return {"id": funnel_id, "message": "Template cloned successfully"}
+    # Only render again when the page changed since it was last cached
+    rendered = renderer.get_cached_page(version["id"], version.get("updated_at"))
+    if rendered is None:
+        page = await repo.get_public_page(version["id"])
+        if not page:
+            raise HTTPException(status_code=404, detail="Page not found")
+        rendered = renderer.render_and_cache(page)
+    
+    return conditional_response(request, rendered.body, rendered.etag, "text/html; charset=utf-8", "public, max-age=60")
+
+@app.get("/static/{funnel_id}/{name}")
+async def get_published_asset(funnel_id: str, name: str):
+    path = await publisher.asset_path(funnel_id, name)
+    if not path:
+        raise HTTPException(status_code=404, detail="Not found")
+    # Asset names are content hashes, so they never change
+    return FileResponse(path, headers={"Cache-Control": "public, max-age=31536000, immutable"})
 
 @app.get("/api/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.utcnow()}
+    return {
+        "status": "healthy",
+        "timestamp": datetime.utcnow(),
+        "caches": {"users": user_cache.stats()}
+    }
+
+@app.get("/api/metrics", response_class=PlainTextResponse)
+async def get_metrics(request: Request):
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+metrics.boot_timer.mark("import")
 
+# Single-process development server; use serve.py to run one worker per core
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -0,0 +1,102 @@
+"""One-time startup tasks across worker processes and nodes.
+
+Every worker runs the startup hook, but index builds, migrations and the
+demo user only need doing once per deploy. run_once lets the first process
+to take a lease in the startup_locks collection run the tasks; the others
+wait until it releases the lease and then skip them. The holder renews its
+lease every STARTUP_LOCK_HEARTBEAT seconds while the tasks run, so long
+migrations are never run twice at once. If the holder dies its lease expires
+after STARTUP_LOCK_TTL seconds, and if its tasks fail it gives the lease up,
+so a waiting process takes over and runs them instead.
+
+Both the holder and the waiting processes call keepalive on every beat;
+serve.py points it at gunicorn's worker heartbeat, so workers are not killed
+for booting slowly while migrations run.
+
+Tasks that need not finish before the server accepts requests (e.g. the
+demo user) are started with in_background.
+"""
+import asyncio
+from datetime import datetime
+import os
+import socket
+import uuid
+import repository as repo
+
+STARTUP_LOCK_TTL = float(os.getenv("STARTUP_LOCK_TTL", 300))
+STARTUP_LOCK_POLL_INTERVAL = float(os.getenv("STARTUP_LOCK_POLL_INTERVAL", 0.5))
+STARTUP_LOCK_HEARTBEAT = float(os.getenv("STARTUP_LOCK_HEARTBEAT", 10))
+
+# Called while startup tasks run or are waited for; set by the process supervisor
+keepalive = None
+
+def _alive():
+    if keepalive is not None:
+        keepalive()
+
+# Strong references, so running background tasks are not garbage collected
+_background = set()
+
+def _report(task: asyncio.Task):
+    _background.discard(task)
+    if not task.cancelled() and task.exception():
+        print(f"✗ Background startup task failed: {task.exception()!r}")
+
+def in_background(coroutine) -> asyncio.Task:
+    task = asyncio.create_task(coroutine)
+    _background.add(task)
+    task.add_done_callback(_report)
+    return task
+
+async def cancel_background():
+    for task in list(_background):
+        task.cancel()
+    await asyncio.gather(*_background, return_exceptions=True)
+
+def owner_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+async def _wait_for_holder(name: str) -> bool:
+    """Wait while another process holds the lock; True if it finished, False if its lease expired"""
+    while True:
+        await asyncio.sleep(STARTUP_LOCK_POLL_INTERVAL)
+        _alive()
+        lock = await repo.get_lock(name)
+        if lock is None:
+            return True
+        if lock["expires_at"] < datetime.utcnow():
+            return False
+
+async def run_once(name: str, tasks: list, ttl: float = STARTUP_LOCK_TTL) -> bool:
+    """Run the async tasks in order unless another process is running them; True if this one ran them"""
+    owner = owner_id()
+    while True:
+        if await repo.acquire_lock(name, owner, ttl):
+            break
+        if await _wait_for_holder(name):
+            print(f"✓ Startup tasks ({name}) completed by another worker")
+            return False
+
+    heartbeat = asyncio.create_task(_heartbeat(name, owner, ttl))
+    try:
+        for task in tasks:
+            await task()
+    except Exception:
+        await _stop(heartbeat)
+        await repo.expire_lock(name, owner)
+        raise
+    await _stop(heartbeat)
+    await repo.release_lock(name, owner)
+    return True
+
+async def _heartbeat(name: str, owner: str, ttl: float):
+    while True:
+        await asyncio.sleep(min(STARTUP_LOCK_HEARTBEAT, ttl / 3))
+        _alive()
+        if not await repo.renew_lock(name, owner, ttl):
+            print(f"✗ Lost the startup lock ({name}) while running startup tasks")
+            return
+
+async def _stop(task: asyncio.Task):
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import repository as repo
+import rollups
+
+@pytest.fixture
+def db():
+    """Point the repository at a fresh in-memory MongoDB"""
+    repo.connect(mongo_client=AsyncMongoMockClient())
+    rollups._cutoff = None
+    rollups._backfilled = False
+    yield repo.db
+    repo.connect(**repo._connection)
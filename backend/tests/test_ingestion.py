@@ -0,0 +1,77 @@
+import asyncio
+from datetime import datetime
+
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+import repository as repo
+from ingestion import EventBuffer, store_events
+
+def make_events(count: int) -> list:
+    timestamp = datetime(2026, 1, 1, 12)
+    return [
+        {"id": f"e{index}", "funnel_id": "f", "page_id": "p", "event_type": "page_view",
+         "timestamp": timestamp, "metadata": {"visitor_id": f"v{index}"}}
+        for index in range(count)
+    ]
+
+def fail_first_insert(monkeypatch, stored: int, error):
+    """Store the first `stored` events of the first insert, then raise error; later inserts are real"""
+    collection = repo.analytics_collection
+    insert_many = collection.insert_many
+    calls = []
+
+    async def flaky_insert_many(events, **kwargs):
+        calls.append(len(events))
+        if len(calls) > 1:
+            return await insert_many(events, **kwargs)
+        for event in events[stored:]:
+            event.setdefault("_id", f"pending-{event['id']}")
+        await insert_many(events[:stored], **kwargs)
+        raise error(events)
+
+    monkeypatch.setattr(collection, "insert_many", flaky_insert_many)
+    return calls
+
+async def page_views() -> int:
+    return (await repo.sum_rollups("f", ["page_view"]))["page_view"]
+
+def test_partial_failure_counts_stored_events_and_retries_the_rest(db, monkeypatch):
+    def error(events):
+        write_errors = [{"index": index, "code": 121, "errmsg": "forced"} for index in range(2, len(events))]
+        return BulkWriteError({"writeErrors": write_errors, "writeConcernErrors": [], "nInserted": 2})
+
+    calls = fail_first_insert(monkeypatch, 2, error)
+
+    async def run():
+        buffer = EventBuffer(store_events, batch_size=10, retry_delay=0)
+        for event in make_events(5):
+            buffer.offer(event)
+        assert not await buffer.flush()
+        assert (len(buffer), buffer.flushed, buffer.failed) == (3, 2, 0)
+        assert await page_views() == 2
+
+        assert await buffer.flush()
+        assert (len(buffer), buffer.flushed, buffer.failed) == (0, 5, 0)
+        assert await page_views() == 5
+        assert await repo.analytics_collection.count_documents({}) == 5
+
+    asyncio.run(run())
+    assert calls == [5, 3]
+
+def test_stored_batch_whose_acknowledgement_was_lost_is_not_counted_twice(db, monkeypatch):
+    calls = fail_first_insert(monkeypatch, 5, lambda events: AutoReconnect("connection reset"))
+
+    async def run():
+        buffer = EventBuffer(store_events, batch_size=10, retry_delay=0)
+        for event in make_events(5):
+            buffer.offer(event)
+        assert not await buffer.flush()
+        assert await page_views() == 0
+
+        assert await buffer.flush()
+        assert (buffer.flushed, buffer.failed) == (5, 0)
+        assert await page_views() == 5
+        assert await repo.analytics_collection.count_documents({}) == 5
+
+    asyncio.run(run())
+    assert calls == [5, 5]
@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+import repository as repo
+from page_patch import PatchConflict, PatchError, apply_page_patch
+
+PAGE = {"id": "page", "user_id": "user", "funnel_id": "funnel", "sections": [],
+        "elements": [{"id": "a", "type": "text"}]}
+
+def patch(operations):
+    return asyncio.run(apply_page_patch("page", "user", operations))
+
+def element_ids():
+    page = asyncio.run(repo.get_page_tree("page", "user"))
+    return [element["id"] for element in page["elements"]]
+
+@pytest.fixture
+def page(db):
+    asyncio.run(repo.create_page(PAGE))
+
+def test_add_rejects_an_id_already_on_the_page(page):
+    with pytest.raises(PatchConflict):
+        patch([{"op": "add", "element": {"id": "a", "type": "text"}}])
+    assert element_ids() == ["a"]
+
+def test_add_rejects_an_id_added_earlier_in_the_same_patch(page):
+    with pytest.raises(PatchConflict):
+        patch([{"op": "add", "element": {"id": "b"}}, {"op": "add", "element": {"id": "b"}}])
+    assert element_ids() == ["a"]
+
+def test_add_accepts_an_id_removed_earlier_in_the_same_patch(page):
+    assert patch([{"op": "remove", "id": "a"}, {"op": "add", "element": {"id": "a", "type": "image"}}]) == "funnel"
+    assert element_ids() == ["a"]
+
+def test_operations_that_match_nothing_are_rejected(page):
+    with pytest.raises(PatchError):
+        patch([{"op": "remove", "id": "missing"}])
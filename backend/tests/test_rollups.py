@@ -0,0 +1,39 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import repository as repo
+import rollups
+from ingestion import store_events
+
+def make_event(index: int, timestamp: datetime) -> dict:
+    return {"id": f"e{index}", "funnel_id": "f", "page_id": "p", "event_type": "page_view",
+            "timestamp": timestamp, "metadata": {}}
+
+async def page_views() -> int:
+    return (await repo.sum_rollups("f", ["page_view"]))["page_view"]
+
+def test_backfill_and_live_counting_never_count_an_event_twice(db, monkeypatch):
+    monkeypatch.setattr(rollups, "ROLLUPS_CUTOFF_DELAY", 0)
+
+    async def run():
+        old = datetime.utcnow() - timedelta(days=2)
+        await repo.insert_events([make_event(index, old) for index in range(3)])
+        cutoff = await rollups.start_live_counting()
+
+        # Tracked while the backfill has not run yet: counted live only
+        await store_events([make_event(index, cutoff + timedelta(seconds=1)) for index in range(3, 5)])
+        assert await page_views() == 2
+        assert not await rollups.backfilled()
+
+        await rollups.backfill_pending()
+        assert await rollups.backfilled()
+        assert await page_views() == 5
+
+        # Rebuilding replaces the backfilled counts instead of adding to them
+        await rollups.backfill()
+        await store_events([make_event(5, cutoff + timedelta(seconds=2))])
+        assert await page_views() == 6
+        hours = await repo.find_rollups("f", "hour", old - timedelta(hours=1), cutoff + timedelta(hours=1))
+        assert sum(row["count"] for row in hours) == 6
+
+    asyncio.run(run())
@@ -0,0 +1,36 @@
+import numpy as np
+
+import uniques
+
+CHECKPOINTS = (100, 1000, 10000, 30000, 41000, 45000, 60000, 82000, 150000)
+TRIALS = 12
+
+def test_estimate_error_across_the_linear_counting_switch():
+    """Mean and RMS relative error stay near 1.04 / sqrt(m) from small counts through 2.5m-5m registers"""
+    errors = {n: [] for n in CHECKPOINTS}
+    for trial in range(TRIALS):
+        registers = sketch([])
+        visitor = 0
+        for n in CHECKPOINTS:
+            while visitor < n:
+                index, rank = uniques.register_for(f"{trial}-{visitor}")
+                registers[index] = max(registers[index], rank)
+                visitor += 1
+            errors[n].append(uniques.estimate(registers) / n - 1)
+    for n, relative in errors.items():
+        relative = np.array(relative)
+        assert abs(relative.mean()) < 0.006, (n, relative.mean())
+        assert np.sqrt(np.mean(relative ** 2)) < 0.012, (n, relative)
+
+def sketch(visitors) -> np.ndarray:
+    registers = np.zeros(uniques.REGISTERS, dtype=np.uint8)
+    for visitor in visitors:
+        index, rank = uniques.register_for(visitor)
+        registers[index] = max(registers[index], rank)
+    return registers
+
+def test_empty_and_merged_sketches():
+    assert uniques.estimate(np.zeros(uniques.REGISTERS, dtype=np.uint8)) == 0
+    first = sketch(f"a{index}" for index in range(5000))
+    second = sketch(f"b{index}" for index in range(5000))
+    assert abs(uniques.estimate(np.maximum(first, second)) / 10000 - 1) < 0.03
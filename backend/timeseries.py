@@ -0,0 +1,70 @@
+"""Analytics time series built from rollups.
+
+Hourly series read hour rollups; daily and weekly series read day rollups
+(weeks start on Monday). Rollup documents are pivoted and re-indexed onto a
+complete bucket range with pandas, so every series is aligned and
+zero-filled. pandas is imported on the first request rather than at
+server start; under serve.py the gunicorn master has already imported it.
+"""
+from datetime import datetime, timedelta, timezone
+import repository as repo
+
+STANDARD_EVENT_TYPES = ["page_view", "button_click", "form_submit"]
+MAX_POINTS = 5000
+
+FREQUENCIES = {"hour": "h", "day": "D", "week": "W-MON"}
+
+def to_utc(timestamp: datetime) -> datetime:
+    """Convert an aware timestamp to naive UTC, as stored in MongoDB"""
+    if timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+def align(timestamp: datetime, granularity: str) -> datetime:
+    timestamp = timestamp.replace(minute=0, second=0, microsecond=0)
+    if granularity == "hour":
+        return timestamp
+    timestamp = timestamp.replace(hour=0)
+    if granularity == "week":
+        timestamp -= timedelta(days=timestamp.weekday())
+    return timestamp
+
+def bucket_range(start: datetime, end: datetime, granularity: str):
+    import pandas as pd
+    return pd.date_range(align(start, granularity), align(end, granularity), freq=FREQUENCIES[granularity])
+
+async def funnel_timeseries(funnel_id: str, start: datetime, end: datetime, granularity: str, page_id: str = None):
+    """Zero-filled counts per event type for each bucket between start and end"""
+    import numpy as np
+    import pandas as pd
+
+    buckets = bucket_range(start, end, granularity)
+    if len(buckets) > MAX_POINTS:
+        raise ValueError(f"Range too large: at most {MAX_POINTS} {granularity} buckets")
+
+    rollup_granularity = "hour" if granularity == "hour" else "day"
+    rows = await repo.find_rollups(funnel_id, rollup_granularity, buckets[0].to_pydatetime(), end, page_id)
+
+    frame = pd.DataFrame(rows, columns=["bucket", "event_type", "count"])
+    if granularity == "week" and not frame.empty:
+        days = pd.to_datetime(frame["bucket"])
+        frame["bucket"] = days - pd.to_timedelta(days.dt.weekday, unit="D")
+    table = frame.pivot_table(index="bucket", columns="event_type", values="count", aggfunc="sum")
+    event_types = STANDARD_EVENT_TYPES + sorted(set(table.columns) - set(STANDARD_EVENT_TYPES))
+    table = table.reindex(index=buckets, columns=event_types, fill_value=0).fillna(0).astype(np.int64)
+
+    views = table["page_view"].to_numpy()
+    submits = table["form_submit"].to_numpy()
+    conversion = np.divide(submits * 100.0, views, out=np.zeros(len(views)), where=views > 0)
+
+    return {
+        "funnel_id": funnel_id,
+        "page_id": page_id,
+        "granularity": granularity,
+        "from": buckets[0].to_pydatetime(),
+        "to": end,
+        "buckets": [bucket.isoformat() for bucket in buckets],
+        "series": {event_type: table[event_type].tolist() for event_type in event_types},
+        "totals": {event_type: int(table[event_type].sum()) for event_type in event_types},
+        "conversion_rate": np.round(conversion, 2).tolist(),
+    }
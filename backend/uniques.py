@@ -0,0 +1,124 @@
+"""Approximate unique visitors with HyperLogLog sketches.
+
+Every tracked event that carries `metadata.visitor_id` (or, failing that,
+`metadata.session_id`) updates one register of a HyperLogLog sketch per
+funnel and day, and one per page and day. Registers are stored sparsely in
+the analytics_uniques collection and raised with $max, so concurrent writers
+merge safely. Sketches for a date range are merged register-wise, giving a
+unique count for the whole range within ~0.8% (HLL_PRECISION = 14).
+Counts are estimated with Ertl's improved estimator, which stays unbiased
+where the classic estimator switches to linear counting.
+Recording is plain Python; numpy is only imported to estimate counts.
+"""
+from collections import defaultdict
+from datetime import datetime
+import hashlib
+import math
+import repository as repo
+from rollups import bucket_start
+
+HLL_PRECISION = 14
+REGISTERS = 1 << HLL_PRECISION
+HASH_BITS = 64
+# Hash bits left for the rank; ranks run from 1 to RANK_BITS + 1
+RANK_BITS = HASH_BITS - HLL_PRECISION
+
+def visitor_id(event: dict):
+    metadata = event.get("metadata")
+    if not isinstance(metadata, dict):
+        return None
+    return metadata.get("visitor_id") or metadata.get("session_id")
+
+def register_for(value) -> tuple:
+    """(register index, rank) a visitor id sets in a sketch"""
+    digest = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+    index = digest >> RANK_BITS
+    rest = digest & ((1 << RANK_BITS) - 1)
+    rank = RANK_BITS - rest.bit_length() + 1
+    return index, rank
+
+def to_array(registers: dict):
+    import numpy as np
+    array = np.zeros(REGISTERS, dtype=np.uint8)
+    for index, rank in (registers or {}).items():
+        array[int(index)] = rank
+    return array
+
+def _sigma(x: float) -> float:
+    if x == 1:
+        return math.inf
+    y, z = 1.0, x
+    while True:
+        x *= x
+        previous = z
+        z += x * y
+        y += y
+        if z == previous:
+            return z
+
+def _tau(x: float) -> float:
+    if x == 0 or x == 1:
+        return 0.0
+    y, z = 1.0, 1 - x
+    while True:
+        x = math.sqrt(x)
+        previous = z
+        y *= 0.5
+        z -= (1 - x) ** 2 * y
+        if z == previous:
+            return z / 3
+
+def estimate(registers) -> int:
+    """Cardinality estimate from the register histogram (Ertl, "New cardinality estimation algorithms
+    for HyperLogLog sketches", 2017)"""
+    import numpy as np
+    counts = np.bincount(registers, minlength=RANK_BITS + 2)
+    z = REGISTERS * _tau(1 - counts[RANK_BITS + 1] / REGISTERS)
+    for rank in range(RANK_BITS, 0, -1):
+        z = 0.5 * (z + counts[rank])
+    z += REGISTERS * _sigma(counts[0] / REGISTERS)
+    return int(round(REGISTERS * REGISTERS / (2 * math.log(2) * z)))
+
+def sketch_updates(events) -> dict:
+    """Highest rank per register, keyed by (funnel_id, page_id, day); page_id None is the whole funnel"""
+    updates = defaultdict(dict)
+    for event in events:
+        visitor = visitor_id(event)
+        if visitor is None:
+            continue
+        index, rank = register_for(visitor)
+        day = bucket_start(event["timestamp"], "day")
+        keys = [(event["funnel_id"], None, day)]
+        if event.get("page_id"):
+            keys.append((event["funnel_id"], event["page_id"], day))
+        for key in keys:
+            registers = updates[key]
+            if rank > registers.get(index, 0):
+                registers[index] = rank
+    return updates
+
+async def record_events(events: list):
+    """Fold a batch of newly stored events into the daily sketches"""
+    updates = sketch_updates(events)
+    if updates:
+        await repo.max_unique_registers(updates)
+
+async def count_uniques(funnel_id: str, start: datetime, end: datetime, page_id: str = None) -> dict:
+    """Unique visitors per day and for the whole range, from the merged daily sketches"""
+    import numpy as np
+
+    docs = await repo.find_unique_sketches(funnel_id, page_id, bucket_start(start, "day"), end)
+    merged = np.zeros(REGISTERS, dtype=np.uint8)
+    daily = []
+    for doc in docs:
+        registers = to_array(doc.get("registers"))
+        np.maximum(merged, registers, out=merged)
+        daily.append({"day": doc["day"], "unique_visitors": estimate(registers)})
+    return {
+        "funnel_id": funnel_id,
+        "page_id": page_id,
+        "from": start,
+        "to": end,
+        "unique_visitors": estimate(merged),
+        "daily": daily,
+    }
@@ -8,7 +8,9 @@ import { Plus, Eye, Trash2, BarChart3, Edit, FileText, Sparkles, ArrowRight, Lay
 const Dashboard = () => {
   const { user } = useAuth();
   const [funnels, setFunnels] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [showCreateModal, setShowCreateModal] = useState(false);
   const [newFunnelName, setNewFunnelName] = useState('');
   const [newFunnelDesc, setNewFunnelDesc] = useState('');
@@ -21,8 +23,9 @@ const Dashboard = () => {
 
   const fetchFunnels = async () => {
     try {
-      const response = await api.get('/api/funnels');
+      const response = await api.get('/api/funnels', { params: { view: 'summary' } });
       setFunnels(response.data);
+      setNextCursor(response.headers['x-next-cursor'] || null);
     } catch (error) {
       console.error('Error fetching funnels:', error);
     } finally {
@@ -30,6 +33,23 @@ const Dashboard = () => {
     }
   };
 
+  const loadMoreFunnels = async () => {
+    if (!nextCursor) return;
+
+    setLoadingMore(true);
+    try {
+      const response = await api.get('/api/funnels', {
+        params: { view: 'summary', cursor: nextCursor },
+      });
+      setFunnels((current) => [...current, ...response.data]);
+      setNextCursor(response.headers['x-next-cursor'] || null);
+    } catch (error) {
+      console.error('Error fetching funnels:', error);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const createFunnel = async () => {
     if (!newFunnelName.trim()) return;
 
@@ -234,6 +254,19 @@ const Dashboard = () => {
           </div>
         )}
 
+        {!loading && nextCursor && (
+          <div className="flex justify-center mt-8">
+            <button
+              onClick={loadMoreFunnels}
+              disabled={loadingMore}
+              className="inline-flex items-center px-6 py-3 glass-dark border border-gray-300 hover:border-gray-400 text-gray-700 rounded-xl transition-all shadow-soft hover:shadow-soft-lg font-medium disabled:opacity-50"
+              data-testid="load-more-funnels"
+            >
+              {loadingMore ? 'Loading...' : 'Load More Funnels'}
+            </button>
+          </div>
+        )}
+
         {/* Create Funnel Modal */}
         {showCreateModal && (
           <div className="fixed inset-0 bg-black/40 backdrop-blur-sm flex items-center justify-center p-4 z-50 animate-fade-in">